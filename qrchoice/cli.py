@@ -12,7 +12,14 @@ def dbg_wrap(f):
       return f(*args, **kwargs)
     except click.Abort:
       pass
+    except click.ClickException:
+      raise
     except :
+      import sys
+      from .database import NewerSchemaVersion
+      e = sys.exc_info()[1]
+      if isinstance(e, NewerSchemaVersion) :
+        raise click.ClickException(str(e))
       import pdb
       if hasattr(pdb, 'xpm') :
         pdb.xpm()
@@ -21,9 +28,21 @@ def dbg_wrap(f):
   return wrapper
 
 
+def engineFromCtx(dbpath):
+  """
+  Engine of the database at dbpath, with the --sqlite-profile given to the command group
+  """
+  from . import database
+  return database.engineFromPath(dbpath, click.get_current_context().obj['sqlite_profile'])
+
+
 @click.group()
-def main():
-  pass
+@click.option('--sqlite-profile', type=click.Choice(['default', 'fast']), default='default', envvar='QRCHOICE_SQLITE_PROFILE',
+    help='PRAGMAs applied to the sqlite connections. "fast" uses a WAL journal, synchronous=NORMAL, a larger page cache, mmap and in-memory temp store.'
+)
+@click.pass_context
+def main(ctx, sqlite_profile):
+  ctx.obj = {'sqlite_profile': sqlite_profile}
 
 @main.command(name="create-db")
 @click.option('--config', '-c', 'conf', type=str)
@@ -40,32 +59,35 @@ def create_db(conf, dbpath):
   with open(conf, 'r') as f :
     cwd = Path(conf)
     conf = config.parse(cwd, f)
-    db = database.DB(conf, database.engineFromPath(dbpath))
+    db = database.DB(conf, engineFromCtx(dbpath))
     db.createIfNeeded()
-    db.fill()
+    def progress(table, count, rate):
+      click.echo(f'{table} : {count} rows ({rate:.0f} rows/s)\r', nl=False)
+    db.fill(progress_cb=progress)
+    print()
 
 @main.command(name='gen-qrc')
 @click.argument('dbpath')
 @click.option('--output', '-o', type=(str, str, str), multiple=True, default = [],
-    help="A triplet of `-o TABLE TEXT DEST` where TEXT and DEST are patterns for each qrcode output path. It can contain %{field} where field is a column in the table."
+    help="A triplet of `-o TABLE TEXT DEST` where TEXT and DEST are patterns for each qrcode output path. It can contain %{field} where field is a column in the table. A DEST ending with .svg is written as a vector SVG."
 )
+@click.option('--jobs', '-j', type=int, default=1, help="Number of processes rendering and saving the images (default: 1, no process pool)")
+@click.option('--force', '-f', is_flag=True, help="Generate all the images, even those whose row, caption and destination didn't change since the last gen-qrc")
 @dbg_wrap
-def gen_qrc(dbpath, output):
+def gen_qrc(dbpath, output, jobs, force):
   """
   Generate images of qr-codes for items in the database
   """
   from . import database
-  from .qrcodes.generator import qrcodeGenerator, RowFormatter, addText
+  from .qrcodes.generator import genQRCodes
   
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
-  for t, text, dest in output :
-    fmt_text = RowFormatter(text)
-    fmt_dest = RowFormatter(dest)
-    for r, im in qrcodeGenerator(db, t) :
-      p = Path(fmt_dest(r))
-      p.parent.mkdir(parents=True, exist_ok=True)
-      im_t = addText(im, fmt_text(r))
-      im_t.save(p)
+  db = database.DB.fromDB(engineFromCtx(dbpath))
+  def progress(done, total):
+    click.echo(f'{100*done/total:>2.2f}%\r', nl=False)
+  skipped = genQRCodes(db, output, jobs, force=force, progress_cb=progress)
+  print()
+  if skipped :
+    click.echo(f'{skipped} unchanged images skipped')
 
 
 a4 = (2480, 3508)
@@ -77,9 +99,8 @@ a4 = (2480, 3508)
 @click.option('--layout', '-y', type=click.Choice(list(layouts.keys()), case_sensitive=False), help='Layout to use. "grid" is the default which arrange as a grid of the largest element size. "brute" tries to find the optimal layout without rotation except 90° ones, but it is slow if many small images. "rectpack" uses the rectpack library, it is fast, similare to "brute", but will unlikely find the optimal solution. Then "pynest" is experimental.')
 @dbg_wrap
 def layoutImg(imgs, output, layout):
-  from .layout import openImage, nestImages, saveAsPDF
-  images = [ openImage(im) for im in imgs ]
-  pages, _ = nestImages(images, a4, layout=layout)
+  from .layout import iterNestedImages, saveAsPDF
+  pages, _ = iterNestedImages(imgs, a4, layout=layout)
   saveAsPDF(output, pages)
 
 
@@ -91,26 +112,27 @@ def layoutImg(imgs, output, layout):
 @click.option('--output', '-o', type=str, help="PDF output file path")
 @click.option('--longside/--shortside', '-l/-s', help="Long side / short side turn")
 @click.option('--layout', '-y', type=click.Choice(list(layouts.keys()), case_sensitive=False), help='Layout to use. "grid" is the default which arrange as a grid of the largest element size. "brute" tries to find the optimal layout without rotation except 90° ones, but it is slow if many small images. "rectpack" uses the rectpack library, it is fast, similare to "brute", but will unlikely find the optimal solution. Then "pynest" is experimental.')
+@click.option('--vector', '-v', is_flag=True, help="Draw the qr codes and their captions as vector shapes in the PDF instead of images (smaller PDF, resolution independent)")
 @dbg_wrap
-def layoutImg(dbpath, table, output, longside, layout):
+def layoutImg(dbpath, table, output, longside, layout, vector):
 
   from . import database
-  from .layout import openImage, nestImages, saveAsPDF, layoutImagesAndQRCodes
+  from .layout import saveAsPDF, iterLayoutPages
   from .qrcodes.generator import qrcodeGenerator, RowFormatter, addText
 
   images = []
   qrcodes = []
   
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
+  db = database.DB.fromDB(engineFromCtx(dbpath))
   for t, text, im_p in table :
     fmt_text = RowFormatter(text)
     fmt_im_p = RowFormatter(im_p)
-    for r, im in qrcodeGenerator(db, t) :
+    for r, im in qrcodeGenerator(db, t, matrix=True) :
       im_t = addText(im, fmt_text(r))
       qrcodes.append(im_t)
-      images.append(openImage(fmt_im_p(r)))
+      images.append(fmt_im_p(r))
 
-  pages = layoutImagesAndQRCodes(images, qrcodes, a4, long_side_turn=longside, layout=layout)
+  pages = iterLayoutPages(images, qrcodes, a4, long_side_turn=longside, layout=layout, vector=vector)
   saveAsPDF(output, pages)
 
 
@@ -119,24 +141,120 @@ def layoutImg(dbpath, table, output, longside, layout):
 @click.argument('paths', type=str, nargs=-1)
 @click.option('--table', '-t', type=str, multiple=True, help="passed as : --table=table:column=value:...")
 @click.option('--id', '-i', type=str, default=None)
+@click.option('--jobs', '-j', type=int, default=1, help="Number of processes used to decode the images (default: 1, no process pool)")
+@click.option('--incremental', '-n', is_flag=True, help="Only decode the images that are new in this run, or whose file changed (size / mtime) since they were read")
+@click.option('--downscale', '-d', type=int, multiple=True, help="Try to decode first on a grayscale copy whose long side is downscaled to this size (px). Can be repeated (e.g. -d 1600 -d 3200), the full resolution is only used if the codes found can't complete a qrchoice template of the run")
+@click.option('--tile-size', type=int, default=None, help="Decode the full resolution image by overlapping tiles of this size (px) to find more small codes")
+@click.option('--tile-overlap', type=int, default=400, help="Overlap of the tiles (px), it should be larger than a qr code (default: 400)")
+@click.option('--tile-threads', type=int, default=1, help="Number of threads decoding the tiles of an image (default: 1)")
+@click.option('--cache', is_flag=True, help="Keep the detections in a cache in the database (keyed by the image content and the reader options), and do not decode again images found in it")
+@click.option('--cache-size', type=int, default=100000, help="Maximum number of images kept in the cache (default: 100000)")
+@click.option('--prefetch', type=int, default=0, help="Number of images read and decoded in advance by background threads when --jobs is 1 (default: 0, no prefetching)")
+@click.option('--prefetch-threads', type=int, default=2, help="Number of threads prefetching the images (default: 2)")
+@click.option('--prefetch-memory', type=int, default=None, help="Stop prefetching while the prefetched images weigh more than this (MB)")
+@click.option('--fallback', is_flag=True, help="On images whose codes don't match any qrchoice template of the run, try again with enhanced filters, then with OpenCV (if installed)")
+@click.option('--fallback-filters', type=str, multiple=True, default=['c+ c+ s+', 'b+ c+', 'b- c+'], help="Filters (as for im-enhance -f) of the fallback stages, tried in order (default: \"c+ c+ s+\", \"b+ c+\", \"b- c+\")")
+@click.option('--filter-search', type=int, default=0, help="On images whose codes don't match any qrchoice template of the run, try up to this number of filter combinations (c+, b-, s+...) until one finds new codes (default: 0, disabled)")
+@click.option('--filter-search-depth', type=int, default=2, help="Maximum number of filters combined by --filter-search (default: 2)")
+@click.option('--filter-search-threads', type=int, default=1, help="Number of threads trying filter combinations at the same time (default: 1)")
+@click.option('--commit-every', type=int, default=500, help="Commit the detections every this number of images (default: 500)")
+@click.option('--commit-interval', type=float, default=60., help="Commit the detections at least every this number of seconds (default: 60)")
+@click.option('--resume', is_flag=True, help="Skip the images up to the last one committed by an interrupted read-qrc of the same run on the same paths")
+@click.option('--queue-size', type=int, default=64, help="Maximum number of detections waiting to be written to the database while the decoding goes on (default: 64)")
+@click.option('--stats', is_flag=True, help="Print the throughput of each stage (loading, decoding, writing) at the end")
+@click.option('--watch', '-w', is_flag=True, help="After reading the images, keep watching the paths (directories / globs) and read the new or modified images as they arrive (stop with Ctrl-C)")
+@click.option('--watch-interval', type=float, default=2., help="Seconds between two scans of the watched paths (default: 2)")
 @dbg_wrap
-def readQrc(dbpath, paths, table, id):
+def readQrc(dbpath, paths, table, id, jobs, incremental, downscale, tile_size, tile_overlap, tile_threads, cache, cache_size, prefetch, prefetch_threads, prefetch_memory, fallback, fallback_filters, filter_search, filter_search_depth, filter_search_threads, commit_every, commit_interval, resume, queue_size, stats, watch, watch_interval):
+  """
+  Read the qr codes of the images at paths and dispatch them. A path can be an image, a directory (scanned recursively)
+  or a quoted glob pattern (e.g. 'shoot/**/*.jpg').
+  """
+  from functools import partial
+  from .images import imGenerator, iterImagePaths, PathWatcher
   from . import database
   from .qrcodes.reader import parseTable, zbarReader, QRChoiceRun
-  from .images import imGenerator
+  from .qrcodes.reader.strategies import MultiScaleReader, TiledReader, FallbackReader, FilteredReader, OpenCVReader, FilterSearchReader
+  from .qrcodes.reader.cache import DecodeCache
+  from .qrcodes.reader.pipeline import ReadPipeline
 
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
+  if tile_size and not 0 <= tile_overlap < tile_size :
+    raise click.BadParameter(f'must be positive and smaller than --tile-size ({tile_size})', param_hint="'--tile-overlap'")
+  db = database.DB.fromDB(engineFromCtx(dbpath))
   tables = [ parseTable(t) for t in table ]
   qrc_run = QRChoiceRun.createOrGetRun(db, tables)
-  im_gen = imGenerator(paths)
-  len_paths = len(paths)
+  expected = qrc_run.expected_codes()
+  reader = zbarReader
+  if tile_size :
+    reader = TiledReader(reader, tile_size, tile_overlap, tile_threads, expected=expected)
+  if downscale :
+    reader = MultiScaleReader(reader, downscale, expected=expected)
+  if fallback :
+    stages = [('primary', reader)]
+    stages.extend( (f'filters "{f}"', FilteredReader(zbarReader, f)) for f in fallback_filters )
+    if OpenCVReader.available :
+      stages.append(('opencv', OpenCVReader()))
+    reader = FallbackReader(stages, expected)
+  if filter_search :
+    reader = FilterSearchReader(
+      reader,
+      max_depth=filter_search_depth,
+      max_tries=filter_search,
+      threads=filter_search_threads,
+      expected=expected,
+    )
+  loader = partial(
+    imGenerator,
+    prefetch=prefetch,
+    threads=prefetch_threads,
+    max_bytes=prefetch_memory and prefetch_memory * 1024 * 1024,
+  )
+  specs = paths
+  if watch :
+    watcher = PathWatcher(specs, interval=watch_interval)
+  paths = iterImagePaths(specs)
+  if watch :
+    paths = watcher.seen(paths)
+  if resume :
+    with db.session() as S :
+      paths = qrc_run.after_checkpoint(S, paths)
+  if incremental :
+    with db.session() as S :
+      paths = qrc_run.changed_imgs(S, paths)
   print()
-  def progress(i, j):
-    click.echo(f'{50*(i+j/len_paths):>2.2f}%\r', nl=False)
-  with db.session() as S :
-    qrc_run.update_imgs(S, map(Path, paths), map(zbarReader.readQRCodes, im_gen), progress_cb=progress)
-    S.commit()
+  def progress(n):
+    click.echo(f'{n} images read\r', nl=False)
+  pipeline = ReadPipeline(
+    qrc_run,
+    reader,
+    jobs,
+    loader=loader,
+    queue_size=queue_size,
+    cache=DecodeCache(reader, cache_size) if cache else None,
+    batch_size=commit_every,
+    interval=commit_interval,
+  )
+  pipeline.run(paths, progress_cb=progress)
   print()
+  if watch :
+    click.echo(f'Watching {", ".join(specs)} (Ctrl-C to stop)')
+    try :
+      for paths in watcher :
+        with db.session() as S :
+          paths = list(qrc_run.changed_imgs(S, paths))
+        if paths :
+          pipeline.run(paths, progress_cb=progress)
+          click.echo(f'\n{len(paths)} new images read')
+    except KeyboardInterrupt :
+      pass
+  if stats :
+    click.echo(pipeline.report())
+  if jobs <= 1 :
+    r = reader
+    while isinstance(r, (FilterSearchReader, FallbackReader)) :
+      if report := r.report() :
+        click.echo(report)
+      r = r.reader if isinstance(r, FilterSearchReader) else None
 
 @main.command(name='browse-db')
 @click.argument('dbpath', type=str, nargs=1)
@@ -146,7 +264,7 @@ def browseDb(dbpath):
   from .qrcodes.reader.gui import QRCTreeModel
   from PySide6.QtWidgets import QTreeView, QApplication
   
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
+  db = database.DB.fromDB(engineFromCtx(dbpath))
   model = QRCTreeModel(db)
   app = QApplication([])
   tv = QTreeView()
@@ -165,40 +283,41 @@ def testGui(dbpath):
   from .qrcodes.reader.gui import QRCFixer
   import sqlalchemy as sa
 
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
+  db = database.DB.fromDB(engineFromCtx(dbpath))
   gui = QRCFixer(db)
   gui.exec()
 
 @main.command(name='redispatch-all')
 @click.argument('dbpath', type=str, nargs=1)
+@click.option('--jobs', '-j', type=int, default=1, help="Number of processes computing the dispatch of the runs (default: 1, no process pool)")
+@click.option('--dry-run', is_flag=True, help="Only report how many images would change target, without writing anything")
 @dbg_wrap
-def redispatchAll(dbpath):
-  import sqlalchemy as sa
+def redispatchAll(dbpath, jobs, dry_run):
   from . import database
-  from .database import _QRCDetectionRun as R, _QRCDetectionImg as I, _QRCDetectionQRC as C, getConverter
-  from .qrcodes.reader import QRChoiceRun
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
-  with db.session() as S :
-    res = S.scalars(sa.select(R)).all()
-    for r in res:
-      run = QRChoiceRun(db, r)
-      imgs = list(S.scalars(sa.select(I.id).where(I.run_id == r.id)).all())
-      run.dispatch(S, imgs)
-      S.commit()
+  from .qrcodes.reader import redispatchRuns
+  db = database.DB.fromDB(engineFromCtx(dbpath))
+  total = [0, 0]
+  def progress(run, count, changed):
+    total[0] += count
+    total[1] += changed
+    click.echo(f'run {run.run.id} : {changed} / {count} images {"would change" if dry_run else "changed"} target')
+  redispatchRuns(db, dbpath, jobs, dry_run, click.get_current_context().obj['sqlite_profile'], progress)
+  click.echo(f'total : {total[1]} / {total[0]} images {"would change" if dry_run else "changed"} target')
 
 @main.command(name='im-enhance')
 @click.option('--filters', '-f', type=str)
 @click.option('--output', '-o', type=click.Path( file_okay=False, dir_okay=True, resolve_path=True))
+@click.option('--prefetch', type=int, default=4, help="Number of images read and decoded in advance by background threads (default: 4)")
+@click.option('--prefetch-threads', type=int, default=2, help="Number of threads prefetching the images (default: 2)")
 @click.argument('paths', type=str, nargs=-1)
-def imEnhance(filters, output:Path, paths):
+def imEnhance(filters, output:Path, prefetch, prefetch_threads, paths):
   """
   Apply filters to images to enhane them
   """
   from . import im_enhancer as ih
-  f = { _f.short_name : _f for _f in ih.imfilters }
-  im_filter = ih.FilterQueue( f[k] for k in filters.split() )
+  im_filter = ih.parseFilters(filters)
   from .images import imGenerator
-  im_gen = imGenerator(paths)
+  im_gen = imGenerator(paths, prefetch, prefetch_threads)
   def progress(i, j):
     click.echo(f'{100*(i/j):>2.2f}%\r', nl=False)
 
@@ -224,7 +343,7 @@ def py(dbpath, debug, i, e):
   from . import database
   from .database import _QRCDetectionRun as R, _QRCDetectionImg as I, _QRCDetectionQRC as C, getConverter
   import sqlalchemy as sa
-  db = database.DB.fromDB(database.engineFromPath(dbpath))
+  db = database.DB.fromDB(engineFromCtx(dbpath))
   user_module = module_from_spec((ModuleSpec('qrc', None)))
   sys.modules['qrc'] = user_module
   ns = user_module.__dict__
@@ -1,13 +1,45 @@
 import sqlalchemy as sa
 import sqlalchemy.orm
+import time
 from pathlib import Path
 from io import StringIO
+from urllib.parse import quote
 
 from .config import Config
 
 
-def engineFromPath(path):
-  return sa.create_engine('sqlite:///' + str(path))
+# PRAGMAs applied on each new sqlite connection
+sqlite_profiles = {
+  'default': {},
+  'fast': {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000, # in KiB when negative
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+  },
+}
+
+def engineFromPath(path, profile='default', read_only=False):
+  """
+  Engine of the sqlite database at path, whose connections get the PRAGMAs of profile (see sqlite_profiles).
+  If read_only, sqlite opens the file read-only (and the journal mode, stored in the file, is left as is).
+  """
+  if read_only :
+    engine = sa.create_engine(f'sqlite:///file:{quote(str(path))}?mode=ro&uri=true')
+  else :
+    engine = sa.create_engine('sqlite:///' + str(path))
+  pragmas = sqlite_profiles[profile]
+  if read_only :
+    pragmas = { k: v for k, v in pragmas.items() if k != 'journal_mode' }
+  if pragmas :
+    @sa.event.listens_for(engine, 'connect')
+    def setPragmas(dbapi_conn, conn_record):
+      cursor = dbapi_conn.cursor()
+      for k, v in pragmas.items() :
+        cursor.execute(f'PRAGMA {k} = {v}')
+      cursor.close()
+  return engine
 
 
 _InternalRegistery = sa.orm.registry()
@@ -37,23 +69,97 @@ class _QRCDetectionRun(ReprMixin):
 @_InternalRegistery.mapped
 class _QRCDetectionImg(ReprMixin):
   __tablename__ = '_qrc_detection_img'
+  __table_args__ = (
+    sa.UniqueConstraint('run_id', 'image_name', name='uq__qrc_detection_img_run_id_image_name'),
+    sa.Index('ix__qrc_detection_img_target_target_id_run_id', 'target', 'target_id', 'run_id'),
+  )
   id = sa.Column(sa.Integer, primary_key=True)
-  run_id = sa.Column(sa.ForeignKey(_QRCDetectionRun.id), index=True)
+  run_id = sa.Column(sa.ForeignKey(_QRCDetectionRun.id))
   image = sa.Column(sa.String(256))
-  image_name = sa.Column(sa.String(256), unique=True)
+  image_name = sa.Column(sa.String(256))
   target = sa.Column(sa.String(128))
   target_id = sa.Column(sa.Integer)
   ignore = sa.Column(sa.Boolean)
+  file_size = sa.Column(sa.Integer) # size and mtime (ns) of the file when it was read, to skip unchanged images
+  file_mtime = sa.Column(sa.Integer)
   
 @_InternalRegistery.mapped
 class _QRCDetectionQRC(ReprMixin):
   __tablename__ = '_qrc_detection_qrc'
+  __table_args__ = (
+    sa.Index('ix__qrc_detection_qrc_img_id_data', 'img_id', 'data'),
+  )
   id = sa.Column(sa.Integer, primary_key=True)
-  img_id = sa.Column(sa.ForeignKey(_QRCDetectionImg.id), index=True)
+  img_id = sa.Column(sa.ForeignKey(_QRCDetectionImg.id))
   data = sa.Column(sa.String(256))
   box = sa.Column(sa.JSON)
 
+@_InternalRegistery.mapped
+class _QRCDecodeCache(ReprMixin):
+  """
+  Detections of previous reads, keyed by a hash of the reader configuration and of the image file content
+  """
+  __tablename__ = '_qrc_decode_cache'
+  key = sa.Column(sa.String(40), primary_key=True)
+  data = sa.Column(sa.JSON)
+  last_used = sa.Column(sa.Float, index=True)
+
   
+# Indexes of older databases that are now prefixes of a composite index / unique constraint
+_superseded_indexes = ['ix__qrc_detection_img_run_id', 'ix__qrc_detection_qrc_img_id', 'ix__qrc_detection_img_run_id_image_name']
+
+def _uniqueColumns(table:sa.Table):
+  return (
+    { tuple(sorted(c.name for c in uc.columns)) for uc in table.constraints if isinstance(uc, sa.UniqueConstraint) } |
+    { (c.name,) for c in table.columns if c.unique }
+  )
+
+def _rebuildTable(conn, table:sa.Table, columns):
+  """
+  Recreate table from the model and copy back its rows (sqlite can't alter constraints)
+  """
+  old = f'_old{table.name}'
+  conn.execute(sa.text('PRAGMA legacy_alter_table = ON')) # Don't rename the foreign keys of the other tables
+  conn.execute(sa.text(f'ALTER TABLE {table.name} RENAME TO {old}'))
+  conn.execute(sa.text('PRAGMA legacy_alter_table = OFF'))
+  for index in sa.inspect(conn).get_indexes(old) :
+    conn.execute(sa.text(f'DROP INDEX {index["name"]}'))
+  table.create(conn)
+  cols = ', '.join( f'"{c.name}"' for c in table.columns if c.name in columns )
+  conn.execute(sa.text(f'INSERT INTO {table.name} ({cols}) SELECT {cols} FROM {old}'))
+  conn.execute(sa.text(f'DROP TABLE {old}'))
+
+# Version of the internal tables, stored in the _qrchoice table. Bump it on any change of the internal models
+# so that existing databases are upgraded (once) by DB.fromDB
+SCHEMA_VERSION = 1
+
+class NewerSchemaVersion(RuntimeError):
+  pass
+
+def upgradeInternalTables(engine: sa.engine.Engine):
+  """
+  Bring the internal tables of an existing database up to date : create the missing tables, add the missing columns and indexes,
+  and rebuild the tables whose unique constraints changed. Then record SCHEMA_VERSION.
+  """
+  _InternalRegistery.metadata.create_all(engine)
+  with engine.begin() as conn :
+    insp = sa.inspect(conn)
+    for table in _InternalRegistery.metadata.sorted_tables :
+      existing = { c['name'] for c in insp.get_columns(table.name) }
+      existing_uniques = { tuple(sorted(u['column_names'])) for u in insp.get_unique_constraints(table.name) }
+      if existing_uniques != _uniqueColumns(table) :
+        _rebuildTable(conn, table, existing)
+        continue
+      for col in table.columns :
+        if col.name not in existing :
+          conn.execute(sa.text(f'ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(engine.dialect)}'))
+      existing_indexes = { i['name'] for i in insp.get_indexes(table.name) }
+      for index in table.indexes :
+        if index.name not in existing_indexes :
+          index.create(conn)
+    for name in _superseded_indexes :
+      conn.execute(sa.text(f'DROP INDEX IF EXISTS {name}'))
+    conn.execute(sa.insert(_Internal.__table__).prefix_with('OR REPLACE'), {'key': 'schema_version', 'value': str(SCHEMA_VERSION)})
 
 
 class DB(object):
@@ -69,21 +175,29 @@ class DB(object):
     _InternalRegistery.metadata.create_all(self.engine)
     with self.session() as s :
       s.add(_Internal(key='config', value=str(self.config)))
+      s.add(_Internal(key='schema_version', value=str(SCHEMA_VERSION)))
       s.commit()
 
   def session(self):
     return sa.orm.Session(self.engine)
 
-  def fill(self):
-    with self.engine.connect() as conn :
+  def fill(self, chunk_size=10000, progress_cb=lambda table, count, rate:None):
+    """
+    Insert the [[Values]] / [[FileValues]] rows, streaming them by chunks of chunk_size rows (one executemany each) in a single transaction.
+    progress_cb is called after each chunk with the table name, the number of rows inserted so far and the rows/s rate.
+    """
+    with self.engine.begin() as conn :
       for t in self.config.tables :
         if t in self.config.values :
           V = self.config.values[t]
           T = self.t[t] #type: sa.Table
           ins = T.insert().values(**{ col: sa.bindparam(str(i)) for i, col in enumerate(V.template) })
-          l = [ { str(i): v for i, v in enumerate(row) } for row in V.generator ]
-          #conn.execute(ins, *( { str(i): v for i, v in enumerate(row) } for row in V.generator ))
-          conn.execute(ins, *l)
+          count = 0
+          t0 = time.perf_counter()
+          for chunk in chunked(( { str(i): v for i, v in enumerate(row) } for row in V.generator ), chunk_size) :
+            conn.execute(ins, chunk)
+            count += len(chunk)
+            progress_cb(t, count, count / max(time.perf_counter() - t0, 1e-9))
 
   def getObjects(self, table):
     T = self.config.sa_model.tables[table]
@@ -99,11 +213,35 @@ class DB(object):
     return self.config.sa_model.tables
 
   @staticmethod
-  def fromDB(engine: sa.engine):
+  def fromDB(engine: sa.engine, upgrade=True):
+    """
+    Open an existing database. Its internal tables are upgraded if they are older than SCHEMA_VERSION (or unversioned),
+    unless not upgrade (e.g. in the worker processes, the main process having already upgraded them).
+    Raise NewerSchemaVersion if the database was written by a newer version of qrchoice (it is never downgraded).
+    """
     from .config import parse
     with sa.orm.Session(engine) as s :
       _c = s.get(_Internal, 'config')
-      return DB(parse(Path(),StringIO(_c.value)), engine)
+      _v = s.get(_Internal, 'schema_version')
+      version = _v and int(_v.value)
+    if version is not None and version > SCHEMA_VERSION :
+      raise NewerSchemaVersion(f'The database schema version is {version}, this version of qrchoice only supports up to {SCHEMA_VERSION} : upgrade qrchoice')
+    if upgrade and (version is None or version < SCHEMA_VERSION) :
+      upgradeInternalTables(engine)
+    return DB(parse(Path(),StringIO(_c.value)), engine)
+
+def chunked(it, size=500):
+  """
+  Split an iterable in lists of at most size elements (to keep IN clauses under the sqlite variable limit)
+  """
+  chunk = []
+  for e in it :
+    chunk.append(e)
+    if len(chunk) >= size :
+      yield chunk
+      chunk = []
+  if chunk :
+    yield chunk
 
 def getConverter(col: sa.Column):
   if isinstance(col.type, sa.Integer) :
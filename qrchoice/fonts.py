@@ -0,0 +1,54 @@
+from io import BytesIO
+from functools import lru_cache
+from fontTools.ttLib import TTFont
+from fontTools.pens.svgPathPen import SVGPathPen
+from fontTools.pens.transformPen import TransformPen
+from fontTools import subset
+
+
+@lru_cache(maxsize=None)
+def loadFont(path) -> TTFont:
+  return TTFont(path, lazy=True)
+
+def glyphName(tt:TTFont, c:str) -> str:
+  return tt.getBestCmap().get(ord(c), '.notdef')
+
+def textWidth(path, text, size) -> float:
+  """
+  Advance width of text drawn with the font at path at size (px), without kerning
+  """
+  tt = loadFont(path)
+  hmtx = tt['hmtx']
+  return sum( hmtx[glyphName(tt, c)][0] for c in text ) * size / tt['head'].unitsPerEm
+
+def textOutline(path, text, x, y, size) -> str:
+  """
+  SVG path data of the glyph outlines of text drawn with the font at path at size (px), from x on the baseline y (y down),
+  so the text doesn't depend on the fonts installed where the SVG is displayed
+  """
+  tt = loadFont(path)
+  glyphs = tt.getGlyphSet()
+  hmtx = tt['hmtx']
+  scale = size / tt['head'].unitsPerEm
+  pen = SVGPathPen(glyphs, ntos=lambda v: f'{v:.2f}'.rstrip('0').rstrip('.'))
+  for c in text :
+    name = glyphName(tt, c)
+    glyphs[name].draw(TransformPen(pen, (scale, 0, 0, -scale, x, y)))
+    x += hmtx[name][0] * scale
+  return pen.getCommands()
+
+def subsetFont(path, chars) -> bytes:
+  """
+  Return the font at path reduced to the glyphs of chars (TrueType data)
+  """
+  options = subset.Options()
+  options.notdef_outline = True
+  options.recalc_bounds = True
+  options.drop_tables += ['FFTM'] # FontForge timestamp, not needed and not known by the subsetter
+  subsetter = subset.Subsetter(options)
+  subsetter.populate(unicodes=[ ord(c) for c in chars ])
+  tt = TTFont(path)
+  subsetter.subset(tt)
+  buf = BytesIO()
+  tt.save(buf)
+  return buf.getvalue()
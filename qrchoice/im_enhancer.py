@@ -143,6 +143,11 @@ class FilterQueue(ImFilter):
       return reduce(lambda x, f: f.cb(x), reduce(lambda a, b: a[:-1] + a[-1].combine(b), filters[1:], [filters[0]]), im)
     else :
       return im
-    
-    
-    
+
+
+def parseFilters(s:str) -> FilterQueue:
+  """
+  Build a FilterQueue from the space separated short names of the filters (e.g. "c+ c+ s-")
+  """
+  f = { _f.short_name : _f for _f in imfilters }
+  return FilterQueue( f[k] for k in s.split() )
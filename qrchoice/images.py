@@ -1,11 +1,357 @@
+import os
+import glob
+from fnmatch import fnmatchcase
+import time
+import hashlib
+from math import ceil
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
-def imGenerator(paths):
+try :
+  import inotify_simple
+except ImportError :
+  inotify_simple = None
+
+IMAGE_EXTENSIONS = frozenset(('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp'))
+
+def loadImage(path) -> Image.Image:
+  """
+  Open and decode the image at path, and close the file
   """
-  This image generator closes the file after each read
+  with Image.open(path) as im :
+    im.load()
+  return im
+
+def openDraft(path, scale, mode=None) -> tuple[Image.Image, float, float]:
+  """
+  Open and decode the image at path reduced by about `scale` (<= 1), optionally converted to mode.
+  JPEG are decoded directly at the smallest DCT scale (1/2, 1/4 or 1/8) that is still at least `scale`, which is much faster
+  and lighter than a full decode, other formats are decoded at full size.
+  Return the image and its actual x and y scales relatively to the full size image.
   """
-  for p in paths :
-    with Image.open(p) as im :
+  with Image.open(path) as im :
+    w, h = im.size
+    if scale < 1 :
+      im.draft(mode, (ceil(w * scale), ceil(h * scale)))
+    if mode is not None and im.mode != mode :
+      im = im.convert(mode)
+    else :
+      im.load()
+  sw, sh = im.size
+  return im, sw / w, sh / h
+
+def imageBytes(im:Image.Image) -> int:
+  w, h = im.size
+  return w * h * len(im.getbands())
+
+def imGenerator(paths, prefetch=0, threads=2, max_bytes=None):
+  """
+  This image generator closes the file after each read.
+  If prefetch > 0, up to `prefetch` next images are read and decoded in advance by `threads` threads (images are still yielded in order),
+  and no more image is prefetched while the images waiting to be yielded weigh more than max_bytes. Images still being decoded
+  are counted as heavy as the largest image decoded so far (and only one is decoded before the first size is known),
+  so the limit is only approximate : it is exceeded by the last image submitted, and by images larger than the previous ones.
+  """
+  if prefetch <= 0 :
+    for p in paths :
+      with Image.open(p) as im :
+        yield im
+    return
+  it = iter(paths)
+  pending = deque()
+  largest = 0
+  with ThreadPoolExecutor(threads) as ex :
+    def reserved():
+      nonlocal largest
+      total = 0
+      for f in pending :
+        if f.done() :
+          size = imageBytes(f.result())
+          largest = max(largest, size)
+        elif largest == 0 :
+          return max_bytes
+        else :
+          size = largest
+        total += size
+      return total
+    def fill():
+      while len(pending) < prefetch :
+        if max_bytes is not None and pending and reserved() >= max_bytes :
+          return
+        try :
+          p = next(it)
+        except StopIteration :
+          return
+        pending.append(ex.submit(loadImage, p))
+    fill()
+    while pending :
+      im = pending.popleft().result()
+      largest = max(largest, imageBytes(im))
+      fill()
       yield im
-    
-  
+
+
+def fileStat(path) -> tuple[int, int]:
+  """
+  Return (size, mtime in ns) of the file at path, or (None, None) if it can't be stat'ed
+  """
+  try :
+    st = os.stat(path)
+  except OSError :
+    return None, None
+  return st.st_size, st.st_mtime_ns
+
+def fileFingerprint(path, salt=b'', block_size=1 << 16) -> str:
+  """
+  Return a hex blake2b digest of the salt, the size and the first and last block_size bytes of the file at path.
+  Reading the whole file to hash it costs as much as a second load of the image : the fingerprint only reads two blocks,
+  at the price of confusing two files of the same size that only differ in the middle (photos differ in their
+  EXIF header and in the end of the entropy coded data).
+  """
+  h = hashlib.blake2b(salt, digest_size=20)
+  with open(path, 'rb') as f :
+    size = os.fstat(f.fileno()).st_size
+    h.update(size.to_bytes(8, 'little'))
+    h.update(f.read(block_size))
+    if size > block_size :
+      f.seek(max(block_size, size - block_size))
+      h.update(f.read(block_size))
+  return h.hexdigest()
+
+
+def dirMtime(path) -> int:
+  """
+  Return the mtime in ns of the directory at path (it changes when an entry is added, removed or renamed), or None
+  """
+  try :
+    return os.stat(path).st_mtime_ns
+  except OSError :
+    return None
+
+def scanImages(directory, extensions=IMAGE_EXTENSIONS):
+  """
+  Lazily yield the image files (by extension) under directory, recursively, with os.scandir (entries of a directory are sorted by name)
+  """
+  with os.scandir(directory) as it :
+    entries = sorted(it, key=lambda e: e.name)
+  for e in entries :
+    if e.is_dir() :
+      yield from scanImages(e.path, extensions)
+    elif e.is_file() and os.path.splitext(e.name)[1].lower() in extensions :
+      yield Path(e.path)
+
+def iterImagePaths(specs, extensions=IMAGE_EXTENSIONS):
+  """
+  Lazily yield the paths of specs : a spec can be a file, a directory (scanned recursively for images, see scanImages)
+  or a glob pattern (`**` is recursive, the matching directories are scanned too)
+  """
+  for spec in specs :
+    spec = str(spec)
+    if os.path.isdir(spec) :
+      yield from scanImages(spec, extensions)
+    elif glob.has_magic(spec) :
+      for p in sorted(glob.iglob(spec, recursive=True)) :
+        if os.path.isdir(p) :
+          yield from scanImages(p, extensions)
+        elif os.path.splitext(p)[1].lower() in extensions :
+          yield Path(p)
+    else :
+      yield Path(spec)
+
+
+def globMatch(pattern:tuple[str], parts:tuple[str], prefix=False) -> bool:
+  """
+  Tell whether the path of parts (see PurePath.parts) is yielded by glob.iglob(pattern, recursive=True) (with the parts of pattern) :
+  wildcards don't match `/`, `**` matches any number of directories, and the names starting with `.` are only matched
+  by a literal `.`.
+  If prefix, tell instead whether paths under parts can be yielded, or be under a yielded directory.
+  """
+  if not parts :
+    return prefix or all( seg == '**' for seg in pattern )
+  if not pattern :
+    return prefix
+  seg = pattern[0]
+  if seg == '**' :
+    return globMatch(pattern[1:], parts, prefix) or (not parts[0].startswith('.') and globMatch(pattern, parts[1:], prefix))
+  if glob.has_magic(seg) :
+    if parts[0].startswith('.') and not seg.startswith('.') :
+      return False
+    if not fnmatchcase(parts[0], seg) :
+      return False
+  elif parts[0] != seg :
+    return False
+  return globMatch(pattern[1:], parts[1:], prefix)
+
+
+class PathWatcher(object):
+  """
+  Watch specs (see iterImagePaths) for new or modified image files.
+  Each call to `wait` blocks until some files are ready and returns them. A file is ready once its size and mtime
+  didn't change for `settle` seconds (so that files still being copied are not read).
+  The specs are never scanned again as a whole : with inotify (if inotify_simple is installed), the events give the files
+  written or moved in, and the new directories are watched (and scanned) as they appear. Without inotify, the mtimes of the
+  directories are checked every `interval` seconds, and only the directories that changed are listed again
+  (so a file rewritten in place is only noticed with inotify).
+  """
+  def __init__(self, specs, interval=2., settle=1., extensions=IMAGE_EXTENSIONS):
+    self.specs = [ str(s) for s in specs ]
+    self.interval = interval
+    self.settle = settle
+    self.extensions = extensions
+    self._seen = {} # type: dict[Path, tuple[int, int]]
+    self._pending = {} # type: dict[Path, tuple[tuple[int, int], float]] # stat, since
+    self._candidates = set() # type: set[Path] # files to check at the next scan
+    self._dirs = {} # type: dict[str, int] # watched directory -> mtime (without inotify)
+    self._wds = {} # type: dict[int, str] # inotify watch descriptor -> directory
+    self._inotify = None
+    if inotify_simple is not None :
+      self._inotify = inotify_simple.INotify()
+    for d in self.roots() :
+      self.watch(d)
+
+  def roots(self) -> list[str]:
+    """
+    Directories from which the specs are watched (the directories of the specs, and the directories of the glob patterns)
+    """
+    res = set()
+    for spec in self.specs :
+      if os.path.isdir(spec) :
+        res.add(spec)
+      elif glob.has_magic(spec) :
+        d = os.path.dirname(spec.split('*', 1)[0].split('?', 1)[0].split('[', 1)[0]) or '.'
+        if os.path.isdir(d) :
+          res.add(d)
+    return sorted(res)
+
+  def wanted(self, directory:Path) -> bool:
+    """
+    Tell whether files of the specs can be under directory (so it must be watched)
+    """
+    for spec in self.specs :
+      if os.path.isdir(spec) :
+        if Path(spec) == directory or Path(spec) in directory.parents :
+          return True
+      elif glob.has_magic(spec) :
+        if globMatch(Path(spec).parts, directory.parts, prefix=True) :
+          return True
+    return False
+
+  def watch(self, directory, scan=False):
+    """
+    Watch directory and its sub-directories that can contain files of the specs (see wanted).
+    If scan, their files are checked at the next scan (for a new directory)
+    """
+    for root, dirs, files in os.walk(directory) :
+      dirs[:] = [ d for d in dirs if self.wanted(Path(root) / d) ]
+      if self._inotify is not None :
+        flags = inotify_simple.flags
+        self._wds[self._inotify.add_watch(root, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)] = root
+      else :
+        self._dirs[root] = dirMtime(root)
+      if scan :
+        self._candidates.update( Path(root) / f for f in files )
+
+  def matches(self, p:Path) -> bool:
+    """
+    Tell whether the image file p is one of the specs (see iterImagePaths)
+    """
+    if p.suffix.lower() not in self.extensions :
+      return False
+    for spec in self.specs :
+      if os.path.isdir(spec) :
+        if Path(spec) in p.parents :
+          return True
+      elif glob.has_magic(spec) :
+        # the files of the matching directories are included
+        if any( globMatch(Path(spec).parts, c.parts) for c in (p, *p.parents) ) :
+          return True
+      elif Path(spec) == p :
+        return True
+    return False
+
+  def markSeen(self, paths):
+    """
+    Do not report paths unless they change later
+    """
+    for p in paths :
+      self._seen[Path(p)] = fileStat(p)
+
+  def seen(self, paths):
+    """
+    Lazily yield paths, marking each one as seen (see markSeen)
+    """
+    for p in paths :
+      self.markSeen([p])
+      yield p
+
+  def poll(self, timeout):
+    """
+    Wait up to timeout seconds for changes, and add the files of the changed directories to the candidates
+    """
+    if self._inotify is not None :
+      flags = inotify_simple.flags
+      for event in self._inotify.read(timeout=int(timeout * 1000)) :
+        if event.mask & flags.IGNORED :
+          self._wds.pop(event.wd, None)
+        d = self._wds.get(event.wd)
+        if d is None or not event.name :
+          continue
+        p = os.path.join(d, event.name)
+        if not event.mask & flags.ISDIR :
+          self._candidates.add(Path(p))
+        elif event.mask & (flags.CREATE | flags.MOVED_TO) and self.wanted(Path(p)) :
+          self.watch(p, scan=True)
+      return
+    time.sleep(timeout)
+    for d, mtime in list(self._dirs.items()) :
+      if (m := dirMtime(d)) == mtime :
+        continue
+      if m is None :
+        del self._dirs[d]
+        continue
+      self._dirs[d] = m
+      try :
+        with os.scandir(d) as it :
+          entries = list(it)
+      except OSError :
+        continue
+      for e in entries :
+        if e.is_dir() :
+          if e.path not in self._dirs and self.wanted(Path(e.path)) :
+            self.watch(e.path, scan=True)
+        else :
+          self._candidates.add(Path(e.path))
+
+  def scan(self) -> list[Path]:
+    """
+    Check the candidate and pending files (and the file specs), and return the files that became ready
+    """
+    now = time.monotonic()
+    ready = []
+    candidates = self._candidates | set(self._pending) | { Path(s) for s in self.specs if os.path.isfile(s) }
+    self._candidates = set()
+    for p in sorted(candidates) :
+      stat = fileStat(p)
+      if stat[0] is None or self._seen.get(p) == stat or not self.matches(p) :
+        self._pending.pop(p, None)
+        continue
+      prev = self._pending.get(p)
+      if prev is None or prev[0] != stat :
+        self._pending[p] = (stat, now)
+      elif now - prev[1] >= self.settle :
+        del self._pending[p]
+        self._seen[p] = stat
+        ready.append(p)
+    return ready
+
+  def wait(self) -> list[Path]:
+    while not (ready := self.scan()) :
+      # check the pending files again after settle, to be sure they are complete
+      self.poll(self.settle if self._pending else self.interval)
+    return ready
+
+  def __iter__(self):
+    while True :
+      yield self.wait()
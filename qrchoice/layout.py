@@ -3,6 +3,8 @@ import numpy as np
 import brutepack
 from icecream import ic
 
+from .pdf import PDFWriter, pdfNumber
+
 dpi = 300
 
 def pasteTransform(dst:Image.Image, src:Image.Image, *args, **kwargs):
@@ -178,29 +180,82 @@ def imageToRect(im):
     (0, h),
   ]
 
-def nestImages(images, page_size, margin=(0,0), layout='grid'):
+def nestSizes(sizes, page_size, margin=(0,0), layout='grid'):
+  """
+  Return the page count, and the (page, quad) of each size, in page coordinates
+  """
   w_m, h_m = margin
   w_p, h_p = page_size
-  page_count, nested = nestRects(( im.size for im in images ), (w_p - 2 * w_m, h_p - 2 * h_m), layout=layout)
-  pages = [ Image.new('RGB', page_size, (255,255,255)) for i in range(page_count) ]
+  page_count, nested = nestRects(sizes, (w_p - 2 * w_m, h_p - 2 * h_m), layout=layout)
   nested = [
       (binId, [ (x + w_m, y + h_m) for x, y in points ])
     for binId, points in nested
   ]
-  for im, (binId, points) in zip(images, nested) :
-    transformQuad(pages[binId], im, points, imageToRect(im))
+  return page_count, nested
+
+def iterPages(page_count, nested):
+  """
+  Yield, for each page, the indexes of the items nested on it
+  """
+  by_page = [ [] for _ in range(page_count) ]
+  for i, (binId, _) in enumerate(nested) :
+    by_page[binId].append(i)
+  yield from by_page
+
+def renderImagePage(images, indexes, nested, page_size, min_sizes=None) -> Image.Image:
+  """
+  Render the page of the images at indexes (see nestSizes), an image can be a path (opened only now, see openImage)
+  """
+  page = Image.new('RGB', page_size, (255,255,255))
+  for i in indexes :
+    im = images[i]
+    if not isinstance(im, Image.Image) :
+      im = openImage(im)
+    if min_sizes is not None :
+      im = ensureImageAtLeastSize(im, min_sizes[i])
+    points = nested[i][1]
+    transformQuad(page, im, points, imageToRect(im))
+  return page
+
+def imageSize(im):
+  if not isinstance(im, Image.Image) :
+    # only the header is read, the pixels aren't decoded
+    with Image.open(im) as im :
+      return scaledSize(im)
+  return im.size
+
+def nestImages(images, page_size, margin=(0,0), layout='grid'):
+  pages, nested = iterNestedImages(images, page_size, margin, layout)
+  return list(pages), nested
+
+def iterNestedImages(images, page_size, margin=(0,0), layout='grid'):
+  """
+  Same as nestImages, but the pages are yielded one by one as they are rendered
+  """
+  images = list(images)
+  page_count, nested = nestSizes([ imageSize(im) for im in images ], page_size, margin, layout)
+  pages = ( renderImagePage(images, indexes, nested, page_size) for indexes in iterPages(page_count, nested) )
   return pages, nested
 
   
-def openImage(path):
-  im = Image.open(path) #type: Image.Image
+def scaledSize(im:Image.Image):
+  """
+  Size of im once resized from its own dpi (if any) to `dpi`
+  """
+  w, h = im.size
   if 'dpi' in im.info :
     try :
       im_dpi_x, im_dpi_y = im.info['dpi']
     except :
       im_dpi_x = im_dpi_y = im.info['dpi']
-    w, h = im.size
-    im = im.resize((w * dpi / im_dpi_x, h * dpi / im_dpi_y))
+    w, h = int(w * dpi / im_dpi_x), int(h * dpi / im_dpi_y)
+  return w, h
+
+def openImage(path):
+  im = Image.open(path) #type: Image.Image
+  size = scaledSize(im)
+  if size != im.size :
+    im = im.resize(size)
   return im
 
 def openRowImages(self, rows, fmt):
@@ -232,44 +287,100 @@ def ensureImageAtLeastSize(im:Image.Image, size):
   return im_n
 
 
-def layoutImagesAndQRCodes(images, qrcodes, page_size, margin=(0,0), long_side_turn=True, layout='grid'):
-  qrcodes = list(qrcodes)
-  images = [
-    ensureImageAtLeastSize(im, qrc.size)
-    for im, qrc in zip(images, qrcodes)
-  ]
-  pages, nested = nestImages(images, page_size, layout=layout)
-  pages_qr = [ Image.new('L', page_size, 0xFF) for _ in range(len(pages)) ]
+class VectorPage(object):
+  """
+  Page of vector drawings, placed as images would be by transformQuad.
+  A drawing has a size (px) and a pdfContent(writer) method (see qrcodes.generator.QRCodeMatrix)
+  """
+  def __init__(self, size):
+    self.size = size
+    self.info = {}
+    self.items = [] # type: list[tuple[object, list[tuple[float, float]]]]
+
+  def add(self, drawing, points):
+    self.items.append((drawing, points))
+
+  def pdfContent(self, writer:PDFWriter) -> bytes:
+    ops = []
+    for drawing, points in self.items :
+      w, h = drawing.size
+      (x0, y0), (x1, y1), _, (x3, y3) = points
+      # affine map of the drawing rect to the quad (the quads of nestImages are rectangles)
+      coefs = ((x1 - x0) / w, (y1 - y0) / w, (x3 - x0) / h, (y3 - y0) / h, x0, y0)
+      ops.append(b'q ' + b' '.join(map(pdfNumber, coefs)) + b' cm\n' + drawing.pdfContent(writer) + b'\nQ')
+    return b'\n'.join(ops)
+
+
+def qrcodeQuad(qrc_size, points, page_size, long_side_turn=True):
+  """
+  Quad of a qr code at the back of the image nested at points (the page is turned on its long or short side)
+  """
   w_p, h_p = page_size
-  for qrc, (binId, points) in zip(qrcodes, nested) :
-    if long_side_turn :
-      points = [ (w_p - x, y) for x, y in points ]
-    else :
-      points = [ (x, h_p - y) for x, y in points ]
-    points = np.array([ points[i] for i in (1, 0, 3, 2) ], dtype=np.float)
-    
-    w_qrc, h_qrc = qrc.size
-    
-    dx = points[1] - points[0] #type: np.ndarray
-    dy = points[3] - points[0] #type: np.ndarray
-    dx *= w_qrc / (np.sqrt(np.sum(dx * dx)))
-    dy *= h_qrc / (np.sqrt(np.sum(dy * dy)))
-
-    points[1,:] = points[0] + dx
-    points[3,:] = points[0] + dy
-    points[2,:] = points[1] + dy
-    points = points.tolist()
-
-    transformQuad(pages_qr[binId], qrc, points, imageToRect(qrc))
-  res = [
-      p
-    for p_img, p_qr in zip(pages, pages_qr)
-    for p in (p_img, p_qr)
+  if long_side_turn :
+    points = [ (w_p - x, y) for x, y in points ]
+  else :
+    points = [ (x, h_p - y) for x, y in points ]
+  points = np.array([ points[i] for i in (1, 0, 3, 2) ], dtype=np.float)
+  
+  w_qrc, h_qrc = qrc_size
+  
+  dx = points[1] - points[0] #type: np.ndarray
+  dy = points[3] - points[0] #type: np.ndarray
+  dx *= w_qrc / (np.sqrt(np.sum(dx * dx)))
+  dy *= h_qrc / (np.sqrt(np.sum(dy * dy)))
+
+  points[1,:] = points[0] + dx
+  points[3,:] = points[0] + dy
+  points[2,:] = points[1] + dy
+  return points.tolist()
+
+def iterLayoutPages(images, qrcodes, page_size, margin=(0,0), long_side_turn=True, layout='grid', vector=False):
+  """
+  Lay images out on pages, each followed by a page with the qr codes at the back of their image.
+  The pages are rendered one at a time as they are yielded, so only one page is in memory if they are consumed
+  as they come (see saveAsPDF). images can be paths, opened only when their page is rendered.
+  qrcodes are images, or qrcodes.generator.QRCodeMatrix, rasterized only when they are pasted on their page.
+  If vector, they must be QRCodeMatrix and their pages are VectorPage.
+  """
+  qrcodes = list(qrcodes)
+  images = list(images)
+  min_sizes = [ qrc.size for qrc in qrcodes ]
+  sizes = [
+      (max(w_im, w_q), max(h_im, h_q))
+    for (w_im, h_im), (w_q, h_q) in zip(map(imageSize, images), min_sizes)
   ]
-  for r in res :
-    r.info['dpi'] = (300, 300)
-  return res
+  page_count, nested = nestSizes(sizes, page_size, margin, layout)
+  for indexes in iterPages(page_count, nested) :
+    page = renderImagePage(images, indexes, nested, page_size, min_sizes)
+    page.info['dpi'] = (dpi, dpi)
+    yield page
+    page_qr = VectorPage(page_size) if vector else Image.new('L', page_size, 0xFF)
+    for i in indexes :
+      qrc = qrcodes[i]
+      points = qrcodeQuad(qrc.size, nested[i][1], page_size, long_side_turn)
+      if vector :
+        page_qr.add(qrc, points)
+      else :
+        if not isinstance(qrc, Image.Image) :
+          qrc = qrc.toImage()
+        transformQuad(page_qr, qrc, points, imageToRect(qrc))
+    page_qr.info['dpi'] = (dpi, dpi)
+    yield page_qr
 
-def saveAsPDF(path,  pages:list[Image.Image]):
-  pages[0].save(path, format='PDF', save_all=True, append_images=pages[1:])
+def layoutImagesAndQRCodes(images, qrcodes, page_size, margin=(0,0), long_side_turn=True, layout='grid', vector=False):
+  """
+  Same as iterLayoutPages, but return the list of all the pages
+  """
+  return list(iterLayoutPages(images, qrcodes, page_size, margin, long_side_turn, layout, vector))
 
+def saveAsPDF(path, pages):
+  """
+  Save pages (PIL images or VectorPage, possibly yielded by a generator) as a PDF at `dpi`.
+  Each page is compressed and written as soon as it is yielded, and then released.
+  """
+  with PDFWriter.open(path, dpi) as writer :
+    for p in pages :
+      if isinstance(p, VectorPage) :
+        writer.page(p.size, p.pdfContent(writer))
+      else :
+        writer.imagePage(p)
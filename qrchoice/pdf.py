@@ -0,0 +1,164 @@
+import zlib
+import hashlib
+from io import BytesIO
+from PIL import Image
+
+from .fonts import loadFont, textWidth, subsetFont
+
+
+def pdfString(s:str) -> bytes:
+  """
+  Encode s as a PDF literal string (WinAnsiEncoding, unknown characters are replaced by '?')
+  """
+  b = s.encode('cp1252', errors='replace')
+  return b'(' + b.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+def pdfNumber(v) -> bytes:
+  return (f'{v:.4f}'.rstrip('0').rstrip('.') if isinstance(v, float) else str(v)).encode('ascii')
+
+
+class PDFWriter(object):
+  """
+  Minimal PDF writer : each object (image, page) is written to f as soon as it is added, so the pages
+  don't need to be kept in memory. Only the fonts (subset to the characters used), the page tree, the catalog and the
+  cross-reference table are written by close.
+  Coordinates of the pages are in pixels at `dpi` with the origin at the top left corner (as PIL images).
+  """
+  def __init__(self, f, dpi=300):
+    self.f = f
+    self.dpi = dpi
+    self._offsets = [] # type: list[int] # offset of each object, 0 if reserved and not written yet
+    self._pages = [] # type: list[int]
+    self._fonts = {} # type: dict[str, tuple[str, int, set[str]]] # path -> resource name, object, characters used
+    self.f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    self._pages_id = self.reserve()
+
+  @classmethod
+  def open(cls, path, dpi=300):
+    return cls(open(path, 'wb'), dpi)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def reserve(self) -> int:
+    self._offsets.append(0)
+    return len(self._offsets)
+
+  def write(self, body:bytes, stream:bytes=None, id:int=None) -> int:
+    """
+    Write the object body (a dictionary if stream is given), followed by stream, and return its number
+    """
+    if id is None :
+      id = self.reserve()
+    self._offsets[id - 1] = self.f.tell()
+    self.f.write(f'{id} 0 obj\n'.encode('ascii'))
+    if stream is None :
+      self.f.write(body)
+    else :
+      self.f.write(body[:-2] + f' /Length {len(stream)} >>\nstream\n'.encode('ascii'))
+      self.f.write(stream)
+      self.f.write(b'\nendstream')
+    self.f.write(b'\nendobj\n')
+    return id
+
+  def image(self, im:Image.Image) -> int:
+    """
+    Write im as a JPEG image XObject (as PIL does for RGB and L pages)
+    """
+    if im.mode not in ('RGB', 'L') :
+      im = im.convert('RGB')
+    buf = BytesIO()
+    im.save(buf, format='JPEG')
+    w, h = im.size
+    cs = '/DeviceRGB' if im.mode == 'RGB' else '/DeviceGray'
+    return self.write(
+      f'<< /Type /XObject /Subtype /Image /Width {w} /Height {h} /ColorSpace {cs} /BitsPerComponent 8 /Filter /DCTDecode >>'.encode('ascii'),
+      buf.getvalue(),
+    )
+
+  def font(self, path, text='') -> str:
+    """
+    Use the TrueType font at path to show text, and return its resource name. Text must then be WinAnsi encoded (see pdfString).
+    The font object is only reserved here : the font is embedded by close, reduced to the characters of all the texts shown with it.
+    """
+    if path not in self._fonts :
+      self._fonts[path] = (f'F{len(self._fonts) + 1}', self.reserve(), set())
+    name, _, chars = self._fonts[path]
+    chars.update( c for c in text.encode('cp1252', errors='replace').decode('cp1252') if c >= ' ' )
+    return name
+
+  def writeFont(self, path, id, chars:set[str]):
+    """
+    Write the font object id, embedding the font at path reduced to chars (see fonts.subsetFont)
+    """
+    tt = loadFont(path)
+    data = subsetFont(path, chars)
+    font_file = self.write(f'<< /Length1 {len(data)} /Filter /FlateDecode >>'.encode('ascii'), zlib.compress(data))
+    head = tt['head']
+    scale = 1000 / head.unitsPerEm
+    ascent, descent = round(tt['hhea'].ascent * scale), round(tt['hhea'].descent * scale)
+    bbox = ' '.join( str(round(v * scale)) for v in (head.xMin, head.yMin, head.xMax, head.yMax) )
+    codes = sorted( c[0] for c in (ch.encode('cp1252') for ch in chars) ) or [32]
+    first, last = codes[0], codes[-1]
+    widths = [
+        round(textWidth(path, bytes([c]).decode('cp1252'), 1000)) if c in codes else 0
+      for c in range(first, last + 1)
+    ]
+    # subset fonts are named with a tag computed from their content
+    tag = ''.join( chr(ord('A') + b % 26) for b in hashlib.md5(data).digest()[:6] )
+    base_name = tag + '+' + tt['name'].getDebugName(6).replace(' ', '')
+    descriptor = self.write((
+      f'<< /Type /FontDescriptor /FontName /{base_name} /Flags 32 /FontBBox [{bbox}]'
+      f' /ItalicAngle 0 /Ascent {ascent} /Descent {descent} /CapHeight {ascent} /StemV 80 /FontFile2 {font_file} 0 R >>'
+    ).encode('ascii'))
+    self.write((
+      f'<< /Type /Font /Subtype /TrueType /BaseFont /{base_name} /FirstChar {first} /LastChar {last}'
+      f' /Widths [{" ".join(map(str, widths))}] /Encoding /WinAnsiEncoding /FontDescriptor {descriptor} 0 R >>'
+    ).encode('ascii'), id=id)
+
+  def page(self, size, content:bytes, images:dict[str, int]=None):
+    """
+    Add a page of size (px) whose content stream draws in pixels from the top left corner.
+    images are the image XObjects used by content (name -> object), all the embedded fonts are available.
+    """
+    w, h = size
+    scale = 72 / self.dpi
+    w_pt, h_pt = w * scale, h * scale
+    content = b' '.join(map(pdfNumber, (scale, 0, 0, -scale, 0, h_pt))) + b' cm\n' + content
+    stream = self.write(b'<< /Filter /FlateDecode >>', zlib.compress(content))
+    resources = ''
+    if images :
+      resources += '/XObject << ' + ' '.join( f'/{k} {v} 0 R' for k, v in images.items() ) + ' >> '
+    if self._fonts :
+      resources += '/Font << ' + ' '.join( f'/{name} {id} 0 R' for name, id, _ in self._fonts.values() ) + ' >> '
+    self._pages.append(self.write((
+      f'<< /Type /Page /Parent {self._pages_id} 0 R /MediaBox [0 0 {pdfNumber(w_pt).decode()} {pdfNumber(h_pt).decode()}]'
+      f' /Resources << {resources}>> /Contents {stream} 0 R >>'
+    ).encode('ascii')))
+
+  def imagePage(self, im:Image.Image):
+    """
+    Add a page showing im at full size
+    """
+    w, h = im.size
+    id = self.image(im)
+    # images are drawn in the unit square, bottom up
+    self.page(im.size, f'q {w} 0 0 {-h} 0 {h} cm /Im0 Do Q'.encode('ascii'), {'Im0': id})
+
+  def close(self):
+    for path, (_, id, chars) in self._fonts.items() :
+      self.writeFont(path, id, chars)
+    self.write(
+      f'<< /Type /Pages /Kids [{" ".join( f"{p} 0 R" for p in self._pages )}] /Count {len(self._pages)} >>'.encode('ascii'),
+      id=self._pages_id,
+    )
+    catalog = self.write(f'<< /Type /Catalog /Pages {self._pages_id} 0 R >>'.encode('ascii'))
+    xref = self.f.tell()
+    self.f.write(f'xref\n0 {len(self._offsets) + 1}\n0000000000 65535 f \n'.encode('ascii'))
+    for offset in self._offsets :
+      self.f.write(f'{offset:010} 00000 n \n'.encode('ascii'))
+    self.f.write(f'trailer\n<< /Size {len(self._offsets) + 1} /Root {catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('ascii'))
+    self.f.close()
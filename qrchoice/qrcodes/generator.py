@@ -1,14 +1,55 @@
 from math import ceil
 import re
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 import qrcode
 
-from ..database import DB
+from ..database import DB, _Internal, chunked
+from ..pdf import PDFWriter, pdfString, pdfNumber
+from ..fonts import textWidth, textOutline
 
 
-def qrcodeGenerator(db:DB, table):
+def qrcodeData(table, pk, row) -> str:
+  return f'{table}:{",".join( str(row[c]) for c in pk )}'
+
+class QRCodeEncoder(object):
+  """
+  Same as qrcode.make, but reuse the same encoder for all the codes
+  """
+  def __init__(self, **kwargs):
+    self._qr = qrcode.QRCode(**kwargs)
+
+  def _make(self, data):
+    qr = self._qr
+    qr.clear()
+    qr.version = None # fit each code from the smallest version, as qrcode.make
+    qr.add_data(data)
+    qr.make()
+    return qr
+
+  def __call__(self, data) -> Image.Image:
+    return self._make(data).make_image()
+
+  def matrix(self, data) -> 'QRCodeMatrix':
+    """
+    Return the code of data as a QRCodeMatrix (with the same size as the image)
+    """
+    qr = self._make(data)
+    return QRCodeMatrix(data, np.array(qr.get_matrix(), dtype=bool), box_size=qr.box_size)
+
+def qrcodeGenerator(db:DB, table, matrix=False):
+  """
+  Yield (row, qr code) for each row of table, the qr code is a PIL image, or a QRCodeMatrix if matrix
+  (a few hundred bytes instead of the image, rasterized or drawn as vectors only when needed)
+  """
   pk = db.getPK(table)
-  return ( (row, qrcode.make(f'{table}:{",".join( str(row[c]) for c in pk )}')) for row in db.getObjects(table) )
+  encoder = QRCodeEncoder()
+  encode = encoder.matrix if matrix else encoder
+  return ( (row, encode(qrcodeData(table, pk, row))) for row in db.getObjects(table) )
 
   
 class RowFormatter(object):
@@ -37,17 +78,209 @@ def fontBaseHeight(font):
   _, h = font.getsize('A')
   return h
 
-def addText(qrc_im:Image.Image, t):
-  wq, hq = qrc_im.size
+def captionLayout(t):
+  """
+  Return (ascent, line spacing, caption height) of the caption t above a qr code
+  """
   a, d = font.getmetrics()
   spacing = (.4) * fontBaseHeight(font)
-  
   wt, ht = font.getsize_multiline(t, spacing=spacing)
-  im_res = Image.new('L', (wq, hq + int(ceil(ht))), 0xFF)
-  im_res.paste(qrc_im, (0, int(ceil(ht))))
+  return a, spacing, int(ceil(ht))
+
+def addText(qrc_im:Image.Image, t):
+  if isinstance(qrc_im, QRCodeMatrix) :
+    return qrc_im.withText(t)
+  wq, hq = qrc_im.size
+  a, spacing, ht = captionLayout(t)
+  im_res = Image.new('L', (wq, hq + ht), 0xFF)
+  im_res.paste(qrc_im, (0, ht))
   imd = ImageDraw.Draw(im_res)
   imd.multiline_text((wq / 2, a), t, fill=0, font=font, anchor='ms', spacing=spacing, align="center")
   im_res.info['dpi'] = (300, 300)
   return im_res
 
-  
+
+class QRCodeMatrix(object):
+  """
+  Qr code of data (optionally captioned) kept as its boolean module matrix (border included, bit packed).
+  It is rasterized (toImage) or drawn as vector shapes (toSVG, pdfContent) only when needed.
+  size is the size in pixels of the same code rendered by QRCodeEncoder and addText.
+  """
+  def __init__(self, data, matrix:np.ndarray, box_size=10, text=None):
+    self.data = data
+    self.modules_count = len(matrix)
+    self._packed = np.packbits(matrix)
+    self.box_size = box_size
+    self.text = text
+    self.caption_height = 0 if text is None else captionLayout(text)[2]
+
+  @property
+  def matrix(self) -> np.ndarray:
+    n = self.modules_count
+    return np.unpackbits(self._packed, count=n * n).reshape(n, n).astype(bool)
+
+  def withText(self, text) -> 'QRCodeMatrix':
+    return QRCodeMatrix(self.data, self.matrix, self.box_size, text)
+
+  @property
+  def size(self):
+    s = self.modules_count * self.box_size
+    return s, s + self.caption_height
+
+  def toImage(self, size:int=None) -> Image.Image:
+    """
+    Rasterize the code with modules scaled to size pixels (default : modules_count * box_size), and add the caption (see addText)
+    """
+    if size is None :
+      size = self.modules_count * self.box_size
+    # module of each pixel
+    idx = np.arange(size) * self.modules_count // size
+    im = Image.fromarray(np.where(self.matrix[idx[:, None], idx[None, :]], 0, 0xFF).astype(np.uint8), 'L')
+    return im if self.text is None else addText(im, self.text)
+
+  def runs(self):
+    """
+    Yield (x, y, length) of the horizontal runs of dark modules
+    """
+    m = self.matrix
+    padded = np.zeros((self.modules_count, self.modules_count + 2), dtype=np.int8)
+    padded[:, 1:-1] = m
+    edges = np.diff(padded, axis=1)
+    for y, row in enumerate(edges) :
+      starts = np.flatnonzero(row == 1)
+      ends = np.flatnonzero(row == -1)
+      for x0, x1 in zip(starts.tolist(), ends.tolist()) :
+        yield x0, y, x1 - x0
+
+  def lines(self):
+    """
+    Yield (line, x, baseline y) of each centered caption line, in pixels (centered with the metrics of the font file,
+    as the vector outputs draw it, see fonts.textWidth)
+    """
+    if self.text is None :
+      return
+    a, spacing, _ = captionLayout(self.text)
+    w, _ = self.size
+    line_height = fontBaseHeight(font) + spacing
+    for i, line in enumerate(self.text.split('\n')) :
+      yield line, (w - textWidth(font.path, line, font.size)) / 2, a + i * line_height
+
+  def toSVG(self) -> str:
+    b = self.box_size
+    w, h = self.size
+    top = self.caption_height
+    path = ''.join( f'M{x * b},{top + y * b}h{n * b}v{b}h{-n * b}z' for x, y, n in self.runs() )
+    # the caption is drawn as glyph outlines, so the SVG doesn't need the font
+    text = ''.join( textOutline(font.path, line, x, y, font.size) for line, x, y in self.lines() )
+    return (
+      f'<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 {w} {h}">'
+      f'<rect width="{w}" height="{h}" fill="#fff"/>'
+      + (f'<path d="{text}" fill="#000"/>' if text else '') +
+      f'<path d="{path}" fill="#000"/>'
+      '</svg>\n'
+    )
+
+  def pdfContent(self, writer:PDFWriter) -> bytes:
+    """
+    Content stream drawing the code in pixels from its top left corner (white background included)
+    """
+    b = self.box_size
+    w, h = self.size
+    top = self.caption_height
+    ops = [f'1 g 0 0 {w} {h} re f 0 g'.encode('ascii')]
+    ops.extend( f'{x * b} {top + y * b} {n * b} {b} re'.encode('ascii') for x, y, n in self.runs() )
+    ops.append(b'f')
+    if self.text is not None :
+      name = writer.font(font.path, self.text)
+      for line, x, y in self.lines() :
+        # text is drawn upward, flip it back in the top-down page coordinates
+        ops.append(b'BT /' + name.encode('ascii') + b' ' + pdfNumber(font.size) + b' Tf 1 0 0 -1 ' + pdfNumber(x) + b' ' + pdfNumber(y) + b' Tm ' + pdfString(line) + b' Tj ET')
+    return b'\n'.join(ops)
+
+
+_encoder = None
+
+def saveQRCodes(tasks:list[tuple[str, str, str]]) -> int:
+  """
+  Render the qr code of data captioned with text, and save it to dest, for each (data, text, dest) of tasks.
+  The encoder (and the font) is created once per process (module level so that it can be sent to a process pool)
+  """
+  global _encoder
+  if _encoder is None :
+    _encoder = QRCodeEncoder()
+  for data, text, dest in tasks :
+    p = Path(dest)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    if p.suffix.lower() == '.svg' :
+      p.write_text(_encoder.matrix(data).withText(text).toSVG(), encoding='utf8')
+    else :
+      addText(_encoder(data), text).save(p)
+  return len(tasks)
+
+def renderKey(data, text) -> str:
+  """
+  Hash of everything that changes the image of a qr code : its data, its caption and the rendering parameters
+  """
+  params = [data, text, font.path, font.size]
+  return hashlib.blake2b(json.dumps(params).encode('utf8'), digest_size=16).hexdigest()
+
+MANIFEST_KEY = 'gen_qrc_manifest'
+
+def loadManifest(db:DB) -> dict[str, str]:
+  """
+  Return the manifest of the generated images (dest -> renderKey), stored in the _qrchoice table
+  """
+  with db.session() as S :
+    entry = S.get(_Internal, MANIFEST_KEY)
+    return json.loads(entry.value) if entry is not None else {}
+
+def saveManifest(db:DB, manifest:dict[str, str]):
+  with db.session() as S :
+    S.merge(_Internal(key=MANIFEST_KEY, value=json.dumps(manifest)))
+    S.commit()
+
+def genQRCodes(db:DB, outputs, jobs=1, chunk_size=200, force=False, progress_cb=lambda done, total:None) -> int:
+  """
+  Generate the captioned qr code images of outputs, a list of (table, text pattern, dest pattern) (see RowFormatter).
+  Destinations ending with .svg are written as vector SVG, the other ones as images.
+  The images whose data, caption and rendering parameters didn't change since they were generated (see the manifest)
+  and that still exist are skipped, unless force.
+  If jobs > 1, the rows are split in chunks of chunk_size, rendered and saved by a pool of `jobs` processes.
+  progress_cb is called, in order, after each chunk with the number of images saved and the total.
+  Return the number of skipped images.
+  """
+  manifest = loadManifest(db)
+  tasks = []
+  keys = {}
+  skipped = 0
+  for t, text, dest in outputs :
+    pk = db.getPK(t)
+    fmt_text = RowFormatter(text)
+    fmt_dest = RowFormatter(dest)
+    for r in db.getObjects(t) :
+      task = (qrcodeData(t, pk, r), fmt_text(r), fmt_dest(r))
+      keys[task[2]] = key = renderKey(*task[:2])
+      if not force and manifest.get(task[2]) == key and Path(task[2]).exists() :
+        skipped += 1
+      else :
+        tasks.append(task)
+  chunks = list(chunked(tasks, chunk_size))
+  done = 0
+  def chunkDone(chunk):
+    nonlocal done
+    done += len(chunk)
+    manifest.update( (dest, keys[dest]) for _, _, dest in chunk )
+    progress_cb(done, len(tasks))
+  try :
+    if jobs > 1 :
+      with ProcessPoolExecutor(jobs) as ex :
+        for chunk, _ in zip(chunks, ex.map(saveQRCodes, chunks)) :
+          chunkDone(chunk)
+    else :
+      for chunk in chunks :
+        saveQRCodes(chunk)
+        chunkDone(chunk)
+  finally :
+    if done :
+      saveManifest(db, manifest)
+  return skipped
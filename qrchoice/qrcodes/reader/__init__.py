@@ -1,13 +1,19 @@
-from functools import reduce
+from functools import partial
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import json
 from contextlib import contextmanager
+import time
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Sequence as Seq
+from typing import Sequence as Seq, Iterable, Iterator
 
 import sqlalchemy as sa
+from PIL import Image
 
-from ...database import DB, _QRCDetectionRun as R, _QRCDetectionImg as I, _QRCDetectionQRC as C, getConverter
+from ...database import DB, engineFromPath, _Internal, _QRCDetectionRun as R, _QRCDetectionImg as I, _QRCDetectionQRC as C, getConverter, chunked
 from ...config.tables import EntrySet
+from ...images import imGenerator, fileStat
 
 from icecream import ic
 
@@ -56,6 +62,80 @@ class BaseReader(object):
     Read qr codes in img, and return a list of tuple (data, [(x0, y0), ..., (x3, y3)]) of the polygon of the read qrcode.
     """
     raise NotImplementedError()
+
+  def configKey(self) -> str:
+    """
+    String identifying the reader and its parameters (two readers with the same key give the same results).
+    Attributes starting with `_` are not parameters.
+    """
+    params = ','.join(
+        f'{k}={_configRepr(v)}'
+      for k, v in sorted(vars(self).items())
+      if not k.startswith('_')
+    )
+    return f'{self.__class__.__name__}({params})'
+
+def _configRepr(v):
+  if isinstance(v, BaseReader) :
+    return v.configKey()
+  if isinstance(v, (list, tuple)) :
+    return '[' + ','.join(map(_configRepr, v)) + ']'
+  return repr(v)
+
+
+class ExpectedCodes(object):
+  """
+  Codes expected in a photo : the arities { field_name: (min, max) } of the qrchoice templates of a run.
+  A detection satisfies it if it matches one of the templates.
+  """
+  def __init__(self, templates:list[dict[str, tuple[float, float]]]):
+    self.templates = templates
+
+  @staticmethod
+  def counts(detection:QRCDetection) -> dict[str, int]:
+    counts = {}
+    for table, _ in ( v for v in (d.split(':') for d in { data for data, _ in detection }) if len(v) == 2 ) :
+      counts[table] = counts.get(table, 0) + 1
+    return counts
+
+  def isSatisfied(self, detection:QRCDetection) -> bool:
+    counts = self.counts(detection)
+    return any(
+        all( (min_ <= counts.get(k, 0) <= max_) for k, (min_, max_) in qrchoice.items() )
+      for qrchoice in self.templates
+    )
+
+  def isComplete(self, detection:QRCDetection) -> bool:
+    """
+    Tell whether detection matches a template that can't take any more code (every field reached its maximal arity).
+    Templates with an unbounded field (e.g. `item:0..*`) are never complete.
+    """
+    counts = self.counts(detection)
+    return any(
+        all( counts.get(k, 0) == max_ and min_ <= max_ for k, (min_, max_) in qrchoice.items() )
+      for qrchoice in self.templates
+    )
+
+  def __repr__(self):
+    return f'ExpectedCodes({self.templates!r})'
+
+def satisfies(detection:QRCDetection, expected) -> bool:
+  """
+  Tell whether detection is enough : expected is either None (at least one code), a minimal number of codes, or an ExpectedCodes
+  """
+  if expected is None :
+    return bool(detection)
+  if isinstance(expected, int) :
+    return len({ data for data, _ in detection }) >= expected
+  return expected.isSatisfied(detection)
+
+def isComplete(detection:QRCDetection, expected) -> bool:
+  """
+  Tell whether a multi-pass reader can stop : same as satisfies, except that an ExpectedCodes must be complete (see ExpectedCodes.isComplete)
+  """
+  if isinstance(expected, ExpectedCodes) :
+    return expected.isComplete(detection)
+  return satisfies(detection, expected)
   
 
 from pyzbar.pyzbar import decode as pyzbar_decode
@@ -74,8 +154,146 @@ class ZBarReader(BaseReader):
 
 
 zbarReader = ZBarReader()
+
+
+def readPath(reader:BaseReader, path) -> QRCDetection:
+  """
+  Open the image at path and read its qr codes (module level so that it can be sent to a process pool)
+  """
+  with Image.open(path) as im :
+    return reader.readQRCodes(im)
+
+def readPaths(reader:BaseReader, paths, jobs=1, window=None, loader=imGenerator):
+  """
+  Read the qr codes of each image in paths and yield the detections in the same order as paths.
+  If jobs > 1, images are opened and decoded in a pool of `jobs` processes, only the detections are sent back.
+  At most `window` images (default : 4 per job) are in flight at the same time.
+  Else, images are loaded with loader (an image generator from paths, see images.imGenerator)
+  """
+  if jobs <= 1 :
+    yield from map(reader.readQRCodes, loader(paths))
+    return
+  if window is None :
+    window = 4 * jobs
+  task = partial(readPath, reader)
+  with ProcessPoolExecutor(jobs) as ex :
+    pending = deque()
+    for p in paths :
+      pending.append(ex.submit(task, p))
+      if len(pending) >= window :
+        yield pending.popleft().result()
+    while pending :
+      yield pending.popleft().result()
     
 
+@dataclass(slots=True)
+class DispatchPlan(object):
+  """
+  Target computed for an image by QRChoiceRun.plan_dispatch (obj_dict are the values of the target object)
+  """
+  im_id: int
+  target: str
+  target_id: int
+  new_target: str
+  obj_dict: dict
+
+
+def _convert(col:sa.Column, v):
+  conv = getConverter(col)
+  if conv is None or v is None :
+    return v
+  try :
+    return conv(v)
+  except ValueError :
+    return v
+
+class UniqueIndex(object):
+  """
+  In-memory index of the rows of a result table over each of its unique constraints.
+  A row matches an object if any unique constraint matches (first one wins).
+  If objs is given, only the rows that can match one of them are loaded (one chunked query per unique constraint),
+  otherwise the whole table is.
+  """
+  @dataclass(frozen=True, slots=True)
+  class Pending(object):
+    """
+    Placeholder for an object that is not inserted yet
+    """
+    table_name: str
+    row: int
+
+  def __init__(self, S:sa.orm.Session, table:sa.Table, objs:Iterable[dict]=None):
+    self.table = table
+    self.ucs = [ list(c.columns) for c in table.constraints if isinstance(c, sa.UniqueConstraint) ]
+    self.maps = [ {} for _ in self.ucs ] # type: list[dict[tuple, int]]
+    if objs is None :
+      rows = ( row._mapping for row in S.execute(sa.select(table)) )
+    else :
+      objs = list(objs)
+      found = {} # type: dict[int, dict]
+      for uc in self.ucs :
+        keys = { self.key(uc, obj) for obj in objs }
+        for chunk in chunked(keys, max(500 // len(uc), 1)) :
+          for row in S.execute(sa.select(table).where(self.keysCond(uc, chunk))) :
+            found[row._mapping['id']] = row._mapping
+      # same order as the whole table
+      rows = ( found[id] for id in sorted(found) )
+    for row in rows :
+      self.add(row, row['id'])
+
+  @staticmethod
+  def keysCond(uc:list[sa.Column], keys:list[tuple]):
+    """
+    Condition on the rows whose uc columns equal one of keys (NULL matching NULL, as in the index)
+    """
+    full = [ k for k in keys if None not in k ]
+    conds = [
+        sa.and_(*( col.is_(None) if v is None else col == v for col, v in zip(uc, k) ))
+      for k in keys if None in k
+    ]
+    if full :
+      conds.append(uc[0].in_([ k[0] for k in full ]) if len(uc) == 1 else sa.tuple_(*uc).in_(full))
+    return sa.or_(*conds)
+
+  def key(self, uc:list[sa.Column], obj) -> tuple:
+    return tuple( _convert(col, obj.get(col.name)) for col in uc )
+
+  def get(self, obj):
+    for uc, m in zip(self.ucs, self.maps) :
+      if (res := m.get(self.key(uc, obj))) is not None :
+        return res
+    return None
+
+  def add(self, obj, id):
+    for uc, m in zip(self.ucs, self.maps) :
+      m.setdefault(self.key(uc, obj), id)
+
+  def insert(self, S:sa.orm.Session, objs:list[dict]) -> list[int]:
+    """
+    Insert objs with one executemany per set of keys (so that the columns an object doesn't set keep their default),
+    and return their ids (in the same order)
+    """
+    table = self.table
+    groups = {} # type: dict[tuple[str], list[int]]
+    for i, obj in enumerate(objs) :
+      groups.setdefault(tuple(sorted(obj)), []).append(i)
+    ids = [None] * len(objs)
+    for indexes in groups.values() :
+      max_id = S.execute(sa.select(sa.func.max(table.c.id))).scalar()
+      S.execute(sa.insert(table), [ objs[i] for i in indexes ])
+      # sqlite allocates increasing rowids in insertion order
+      group_ids = S.scalars(sa.select(table.c.id).where(table.c.id > (max_id or 0)).order_by(table.c.id)).all()
+      assert len(group_ids) == len(indexes)
+      for i, id in zip(indexes, group_ids) :
+        ids[i] = id
+    for obj, id in zip(objs, ids) :
+      for uc, m in zip(self.ucs, self.maps) :
+        k = self.key(uc, obj)
+        if isinstance(m.get(k), self.Pending) :
+          m[k] = id
+    return ids
+
+
 class QRChoiceRun(object):
   """
   Class to store data for a QRChoice run on a set of images
@@ -120,62 +338,181 @@ class QRChoiceRun(object):
       S.refresh(run)
       return cls(db, run)
 
+  def changed_imgs(self, S:sa.orm.Session, img_paths:Iterable[Path]) -> Iterator[Path]:
+    """
+    Lazily filter the paths that are not yet in this run, or whose file size / mtime changed since they were read.
+    The stats of the run are loaded at once with S, so the result can be iterated after S is closed.
+    """
+    known = {
+        name: (size, mtime)
+      for name, size, mtime in S.execute(sa.select(I.image_name, I.file_size, I.file_mtime).where(I.run_id == self.run.id))
+    }
+    return (
+        p
+      for p in img_paths
+      if (stat := known.get(p.name)) is None or stat[0] is None or stat != fileStat(p)
+    )
+
   def update_imgs(self, S:sa.orm.Session, img_paths:Seq[Path], data:Seq[QRCDetection], progress_cb=lambda i, j:None):
     """
     Add or update the image bounding box. Only add boxes, don't remove.
+    Only the images of img_paths are queried, so it can be called on successive batches of a long run (see update_imgs_batched)
     """
     rid = self.run.id
-    im_ids = [] # type: list[tuple[int, bool] # pk, is new
-    stmt_im_sel = sa.select(I).where((I.image_name == sa.bindparam('im_name')) & (I.run_id == rid))
-    stmt_im_ins = sa.insert(I)
+    stmt_im_stat = (
+      sa.update(I.__table__)
+      .where(I.id == sa.bindparam('im_id'))
+      .values(file_size=sa.bindparam('size'), file_mtime=sa.bindparam('mtime'))
+    )
+    img_paths = list(img_paths)
+    def imIds(names):
+      res = {}
+      for chunk in chunked(names) :
+        res.update(S.execute(sa.select(I.image_name, I.id).where((I.run_id == rid) & I.image_name.in_(chunk))).all())
+      return res
+    existing = imIds({ p.name for p in img_paths }) # type: dict[str, int]
+    new_imgs = {} # type: dict[str, dict]
+    stats = []
     for i, p in enumerate(img_paths) :
-      p_s = str(p)
       name = p.name
-      imgs = S.scalars(stmt_im_sel, {'im_name': name}).all()
-      assert len(imgs) <= 1
-      if len(imgs) == 1 :
-        im_ids.append((imgs[0].id, False))
-      else :
-        im_ids.append((
-          S.execute(stmt_im_ins, {'run_id': rid, 'image': p_s, 'image_name': name}).inserted_primary_key[0],
-          True
-        ))
+      size, mtime = fileStat(p)
+      if name in existing :
+        stats.append({'im_id': existing[name], 'size': size, 'mtime': mtime})
+      elif name not in new_imgs :
+        new_imgs[name] = {'run_id': rid, 'image': str(p), 'image_name': name, 'file_size': size, 'file_mtime': mtime}
       progress_cb(0, i)
-    S.flush()
-    stmt_qrc_data_sel = sa.select(C.data).where(C.img_id == sa.bindparam('im'))
-    stmt_qrc_ins = sa.insert(C)
+    if stats :
+      S.execute(stmt_im_stat, stats)
+    if new_imgs :
+      S.execute(sa.insert(I.__table__), list(new_imgs.values()))
+      ids = { **existing, **imIds(new_imgs) }
+    else :
+      ids = existing
+    im_ids = [ (ids[p.name], p.name in new_imgs) for p in img_paths ] # type: list[tuple[int, bool]] # pk, is new
+    #get existing box data of all the images at once
+    qrcs = {} # type: dict[int, set[str]]
+    for chunk in chunked(existing.values()) :
+      for im_id, d in S.execute(sa.select(C.img_id, C.data).where(C.img_id.in_(chunk))) :
+        qrcs.setdefault(im_id, set()).add(d)
+    to_insert = []
     to_dispatch = []
     for i, ((im_id, is_new), detect) in enumerate(zip(im_ids, data)) :
-      #get existing box data
-      qrcs = set(S.scalars(stmt_qrc_data_sel, {'im': im_id}))
-      to_insert = [ {'img_id': im_id, 'data':d, 'box': box} for (d, box) in detect if d not in qrcs ]
+      im_qrcs = qrcs.setdefault(im_id, set())
+      inserted = False
+      for d, box in detect :
+        if d not in im_qrcs :
+          im_qrcs.add(d)
+          to_insert.append({'img_id': im_id, 'data':d, 'box': box})
+          inserted = True
       progress_cb(1, i)
-      if is_new or to_insert :
+      if is_new or inserted :
         to_dispatch.append(im_id)
-      S.execute(stmt_qrc_ins, to_insert)
-      S.flush()
+    if to_insert :
+      S.execute(sa.insert(C), to_insert)
+    S.flush()
     self.dispatch(S, to_dispatch)
 
+  def update_imgs_batched(self, S:sa.orm.Session, results:Iterable[tuple[Path, QRCDetection]], batch_size=500, interval=60., progress_cb=lambda n:None):
+    """
+    Same as update_imgs for (path, detection) pairs, but commit every batch_size images or every interval seconds (whichever comes first),
+    together with a checkpoint of the last image written (see checkpoint), so an interrupted run keeps what it already read :
+    if getting the next result raises (e.g. KeyboardInterrupt), the images received so far are committed before the exception
+    is propagated. The checkpoint is cleared once results is exhausted.
+    progress_cb is called with the number of images received after each image (whether or not it is committed yet).
+    """
+    results = iter(results)
+    done = 0
+    batch_paths, batch = [], []
+    def commit():
+      self.update_imgs(S, batch_paths, batch)
+      self.set_checkpoint(S, batch_paths[-1])
+      S.commit()
+    start = time.monotonic()
+    while True :
+      try :
+        p, detection = next(results)
+      except StopIteration :
+        break
+      except BaseException :
+        if batch :
+          commit()
+        raise
+      batch_paths.append(p)
+      batch.append(detection)
+      done += 1
+      progress_cb(done)
+      if len(batch) >= batch_size or time.monotonic() - start >= interval :
+        commit()
+        batch_paths, batch = [], []
+        start = time.monotonic()
+    if batch :
+      commit()
+    self.set_checkpoint(S, None)
+    S.commit()
+
+  def after_checkpoint(self, S:sa.orm.Session, img_paths:Iterable[Path]) -> Iterator[Path]:
+    """
+    Lazily skip the paths up to the checkpoint of an interrupted update_imgs_batched (included).
+    If there is no checkpoint, or if it is not among the paths, all the paths are yielded (in the latter case,
+    the paths are kept in memory until the end).
+    """
+    checkpoint = self.checkpoint(S)
+    def after():
+      skipped = []
+      it = iter(img_paths)
+      for p in it :
+        if str(p) == checkpoint :
+          yield from it
+          return
+        skipped.append(p)
+      yield from skipped
+    return iter(img_paths) if checkpoint is None else after()
+
+  @property
+  def _checkpoint_key(self):
+    return f'checkpoint_{self.run.id}'
+
+  def checkpoint(self, S:sa.orm.Session) -> str:
+    """
+    Path of the last image committed by an unfinished update_imgs_batched of this run (None if the last one completed)
+    """
+    entry = S.get(_Internal, self._checkpoint_key)
+    return entry and entry.value
+
+  def set_checkpoint(self, S:sa.orm.Session, path:Path):
+    if path is None :
+      S.execute(sa.delete(_Internal).where(_Internal.key == self._checkpoint_key))
+    else :
+      S.merge(_Internal(key=self._checkpoint_key, value=str(path)))
+
   def dispatch(self, S:sa.orm.Session, im_ids:list[int]):
     """
     Dispatch the images among the result table (assign target and target_id)
     """
-    stmt_qrcdata_sel = sa.select(C.data).where((C.img_id == sa.bindparam('im_id')) & (C.data != None))
-    stmt_target_sel = sa.select(I.target, I.target_id, I.ignore).where(I.id == sa.bindparam('im_id'))
-    stmt_update_im = (
-      sa.update(I)
-      .where(I.id == sa.bindparam('im_id'))
-      .values(target=sa.bindparam('target'), target_id=sa.bindparam('target_id'))
-    )
-    to_update = set()
+    self.apply_dispatch(S, self.plan_dispatch(S, im_ids))
+
+  def plan_dispatch(self, S:sa.orm.Session, im_ids:list[int]) -> list['DispatchPlan']:
+    """
+    Compute, without writing anything, the target table and the target object of each image.
+    The QRC data of all the images is loaded at once.
+    """
+    im_ids = list(im_ids)
+    targets = {} # type: dict[int, tuple[str, int, bool]]
+    data = {} # type: dict[int, list[str]]
+    for chunk in chunked(im_ids) :
+      for im_id, target, target_id, ignore in S.execute(sa.select(I.id, I.target, I.target_id, I.ignore).where(I.id.in_(chunk))) :
+        targets[im_id] = (target, target_id, ignore)
+      for im_id, d in S.execute(sa.select(C.img_id, C.data).where(C.img_id.in_(chunk) & (C.data != None))) :
+        if d :
+          data.setdefault(im_id, []).append(d)
+    plans = []
     for im_id in im_ids :
-      target, target_id, ignore = S.execute(stmt_target_sel, {'im_id': im_id}).one()
-      data = [ d for d in S.scalars(stmt_qrcdata_sel, {'im_id': im_id}).all() if d ]
+      target, target_id, ignore = targets[im_id]
       new_target = None
-      new_target_id = None
+      obj_dict = None
       filtered = dict()
       if not ignore :
-        for table, id in ( v for v in (d.split(':') for d in data) if len(v) == 2 ) :
+        for table, id in ( v for v in (d.split(':') for d in data.get(im_id, [])) if len(v) == 2 ) :
           filtered.setdefault(table, []).append(id)
         # match target
         for table_name, _ in self.run.data :
@@ -192,79 +529,205 @@ class QRChoiceRun(object):
               k = next(iter(table.fks[k].columns.values())).name # change for supporting composite pk
             v, = v
             obj_dict[k] = v
-        
+      plans.append(DispatchPlan(im_id, target, target_id, new_target, obj_dict))
+    return plans
+
+  def plan_redispatch(self, S:sa.orm.Session) -> list['DispatchPlan']:
+    """
+    Dispatch plans of all the images of this run (see plan_dispatch)
+    """
+    return self.plan_dispatch(S, S.scalars(sa.select(I.id).where(I.run_id == self.run.id)).all())
+
+  def apply_dispatch(self, S:sa.orm.Session, plans:list['DispatchPlan'], indexes:dict[str, 'UniqueIndex']=None):
+    """
+    Resolve the target objects of the plans against the unique constraints of the result tables (creating the missing ones in bulk),
+    then assign target and target_id to the images, and update the result tables.
+    The missing indexes are loaded with the rows that can match the plans only (see UniqueIndex).
+    """
+    if indexes is None :
+      indexes = {}
+    to_update = set()
+    new_target_ids = [] # type: list[int | UniqueIndex.Pending]
+    pending = {} # type: dict[str, list[dict]]
+    for plan in plans :
+      new_target_id = None
+      if plan.new_target is not None :
+        table, _ = self.qrchoices[plan.new_target]
+        if (index := indexes.get(plan.new_target)) is None :
+          index = indexes[plan.new_target] = UniqueIndex(S, table, targetObjs(plans, plan.new_target))
         # match target_id
-        # cond = (uc1.c1 == o[uc1.c1] & uc1.col2 == o[uc1.c2] & ...) | (uc2.c1 == o[uc2.c1] & uc2.c2 == o[uc2.c2] & ...) | ...
-        cond = reduce(lambda x, y: x | y, (
-            reduce(lambda x, y: x & y, (
-                col == obj_dict[col.name]
-              for col in uc 
-            ))
-          for uc in ( c for c in table.constraints if isinstance(c, sa.UniqueConstraint) )
-        ))
-        res = S.execute(sa.select(table).where(cond)).all()
-        assert len(res) <= 1
-        if len(res) != 0 :
-          res = res[0]
-          new_target_id = res['id']
-        else :
-          new_target_id = S.execute(sa.insert(table), obj_dict).inserted_primary_key[0]
-          S.flush()
-        to_update.add((new_target, new_target_id))
-      if target is not None and target_id is not None :
-        to_update.add((target, target_id))
-      S.execute(stmt_update_im, {'im_id': im_id, 'target':new_target, 'target_id':new_target_id})
-      S.flush()
+        new_target_id = index.get(plan.obj_dict)
+        if new_target_id is None :
+          l = pending.setdefault(plan.new_target, [])
+          new_target_id = UniqueIndex.Pending(plan.new_target, len(l))
+          l.append(plan.obj_dict)
+          index.add(plan.obj_dict, new_target_id)
+      new_target_ids.append(new_target_id)
+    created = {} # type: dict[str, list[int]]
+    for table_name, objs in pending.items() :
+      created[table_name] = indexes[table_name].insert(S, objs)
+    im_updates = []
+    for plan, new_target_id in zip(plans, new_target_ids) :
+      if isinstance(new_target_id, UniqueIndex.Pending) :
+        new_target_id = created[new_target_id.table_name][new_target_id.row]
+      if plan.new_target is not None :
+        to_update.add((plan.new_target, new_target_id))
+      if plan.target is not None and plan.target_id is not None :
+        to_update.add((plan.target, plan.target_id))
+      if (plan.target, plan.target_id) != (plan.new_target, new_target_id) :
+        im_updates.append({'im_id': plan.im_id, 'target': plan.new_target, 'target_id': new_target_id})
+    if im_updates :
+      S.execute(
+        sa.update(I.__table__)
+        .where(I.id == sa.bindparam('im_id'))
+        .values(target=sa.bindparam('target'), target_id=sa.bindparam('target_id')),
+        im_updates
+      )
+    S.flush()
     self.update_res(S, to_update)
 
+  def count_changes(self, S:sa.orm.Session, plans:list['DispatchPlan'], indexes:dict[str, 'UniqueIndex']=None) -> int:
+    """
+    Return the number of images whose target would change if plans were applied (nothing is written)
+    """
+    if indexes is None :
+      indexes = {}
+    res = 0
+    for plan in plans :
+      new_target_id = None
+      if plan.new_target is not None :
+        if (index := indexes.get(plan.new_target)) is None :
+          index = indexes[plan.new_target] = UniqueIndex(S, self.qrchoices[plan.new_target][0], targetObjs(plans, plan.new_target))
+        new_target_id = index.get(plan.obj_dict)
+        if new_target_id is None :
+          # the object would be created
+          res += 1
+          continue
+      if (plan.target, plan.target_id) != (plan.new_target, new_target_id) :
+        res += 1
+    return res
+
   def update_res(self, S:sa.orm.Session, targets: Seq[tuple[str, int]]):
     """
     Update result tables records based on all image referring them...
+    The QRC data of all the targets is read with one joined query per table (and chunk of ids),
+    then the main tables are updated with executemany, and only the changed rows of the set tables are deleted / inserted.
     """
-    stmt_sel_qrcdata = sa.select(C.data).where(
-      (I.target == sa.bindparam('target')) &
-      (I.target_id == sa.bindparam('target_id')) &
-      (C.img_id == I.id)
-    )
+    by_table = {} # type: dict[str, list[int]]
     for target, target_id in targets :
+      by_table.setdefault(target, []).append(target_id)
+    for target, target_ids in by_table.items() :
       table, qrchoice = self.qrchoices[target]
-      data = set(( d for d in S.scalars(stmt_sel_qrcdata, {'target':target, 'target_id': target_id}).all() if d))
-      filtered = dict()
-      for field_name, id in ( v for v in (d.split(':') for d in data) if len(v) == 2) :
-        filtered.setdefault(field_name, []).append(id)
-      obj_dict = dict(self.default_values[target])
-      sets = [] # type: list[tuple[EntrySet, list[int]]]
-      do_update = True
-      for k, v in filtered.items() :
-        if k not in table.sets :
-          if not k in table.c :
-            k = next(iter(table.fks[k].columns.values())).name # change for supporting composite pk
-          if len(v) == 1 :
-            v, = v
-            obj_dict[k] = v
-        else :
-          sets.append((table.sets[k],  v))
-      # Update main object
-      S.execute(sa.update(table).where(table.c.id == target_id).values(obj_dict))
-      S.flush()
+      data = { target_id: set() for target_id in target_ids } # type: dict[int, set[str]]
+      for chunk in chunked(target_ids) :
+        stmt = (
+          sa.select(I.target_id, C.data)
+          .join(C, C.img_id == I.id)
+          .where((I.target == target) & I.target_id.in_(chunk))
+        )
+        for target_id, d in S.execute(stmt) :
+          if d :
+            data[target_id].add(d)
+      updates = {} # type: dict[tuple[str], list[dict]]
+      sets = {} # type: dict[str, dict[int, set]]
+      for target_id, im_data in data.items() :
+        filtered = dict()
+        for field_name, id in ( v for v in (d.split(':') for d in im_data) if len(v) == 2) :
+          filtered.setdefault(field_name, []).append(id)
+        obj_dict = dict(self.default_values[target])
+        for k, v in filtered.items() :
+          if k not in table.sets :
+            if not k in table.c :
+              k = next(iter(table.fks[k].columns.values())).name # change for supporting composite pk
+            if len(v) == 1 :
+              v, = v
+              obj_dict[k] = v
+          else :
+            s = table.sets[k]
+            pk_col = next(iter(s.target.primary_key)) # change for supporting composite pk
+            sets.setdefault(k, {})[target_id] = { _convert(pk_col, _v) for _v in v }
+        if obj_dict :
+          updates.setdefault(tuple(sorted(obj_dict)), []).append({ '_id': target_id } | { f'_v_{k}': v for k, v in obj_dict.items() })
+      # Update main objects
+      for keys, params in updates.items() :
+        S.execute(
+          sa.update(table)
+          .where(table.c.id == sa.bindparam('_id'))
+          .values({ k: sa.bindparam(f'_v_{k}') for k in keys }),
+          params
+        )
       # Update sets
-      for s, vals in sets :
-        S.execute(sa.delete(s.mid).where(s.src_pk_cond(target_id)))
-        S.flush()
-        S.execute(sa.insert(s.mid).values([
+      for k, members in sets.items() :
+        s = table.sets[k] # type: EntrySet
+        src_col, = s.src_fk_cols() # change for supporting composite pk
+        target_col, = s.target_fk_cols()
+        existing = { target_id: set() for target_id in members } # type: dict[int, set]
+        for chunk in chunked(members) :
+          for src_id, target_pk in S.execute(sa.select(src_col, target_col).where(src_col.in_(chunk))) :
+            existing[src_id].add(target_pk)
+        to_delete = [
+            {'_src': target_id, '_target': v}
+          for target_id, vals in existing.items()
+          for v in vals - members[target_id]
+        ]
+        to_insert = [
             s.populate_target(s.populate_src(dict(), target_id), v)
-          for v in vals
-        ]))
-        S.flush()
+          for target_id, vals in members.items()
+          for v in vals - existing[target_id]
+        ]
+        if to_delete :
+          S.execute(sa.delete(s.mid).where(s.src_pk_cond(sa.bindparam('_src')) & s.target_pk_cond(sa.bindparam('_target'))), to_delete)
+        if to_insert :
+          S.execute(sa.insert(s.mid), to_insert)
+    S.flush()
+
+  def expected_codes(self) -> ExpectedCodes:
+    """
+    Codes a photo of this run should contain to be dispatched (hint for the readers)
+    """
+    return ExpectedCodes([ self.qrchoices[table_name][1] for table_name, _ in self.run.data ])
 
   @property
   def qrchoices(self):
     return self.db.config.qrchoices
-      
-
-
-
 
 
+def targetObjs(plans:list[DispatchPlan], table_name:str) -> Iterator[dict]:
+  return ( plan.obj_dict for plan in plans if plan.new_target == table_name )
 
+def planDispatch(dbpath, run_id:int, profile='default') -> list[DispatchPlan]:
+  """
+  Open the database at dbpath and return the dispatch plans of all the images of the run (module level so that it can be sent to a process pool).
+  The database is opened read-only, and its internal tables are not upgraded (the caller opened the database already).
+  """
+  db = DB.fromDB(engineFromPath(dbpath, profile, read_only=True), upgrade=False)
+  with db.session() as S :
+    return QRChoiceRun(db, S.get(R, run_id)).plan_redispatch(S)
 
+def redispatchRuns(db:DB, dbpath, jobs=1, dry_run=False, profile='default', progress_cb=lambda run, count, changed:None):
+  """
+  Dispatch again the images of all the runs.
+  The plans of the runs (see QRChoiceRun.plan_dispatch) are computed in a pool of `jobs` processes if jobs > 1,
+  then applied in a single transaction, sharing the unique indexes of the result tables between the runs.
+  If jobs == 1, each run is planned in that same transaction just before being applied (a run only reads its own images,
+  that the previous runs don't modify).
+  The workers open the database with the sqlite profile (see database.engineFromPath).
+  progress_cb is called for each run with its number of images, and the number of them whose target changes.
+  If dry_run, nothing is written.
+  """
+  with db.session() as S :
+    run_ids = S.scalars(sa.select(R.id).order_by(R.id)).all()
+    plans = None
+    if jobs > 1 :
+      with ProcessPoolExecutor(jobs) as ex :
+        plans = list(ex.map(partial(planDispatch, dbpath, profile=profile), run_ids))
+    # every image may be dispatched again : load the whole result tables once
+    indexes = { table_name: UniqueIndex(S, table) for table_name, (table, _) in db.config.qrchoices.items() }
+    for i, run_id in enumerate(run_ids) :
+      run = QRChoiceRun(db, S.get(R, run_id))
+      run_plans = plans[i] if plans is not None else run.plan_redispatch(S)
+      progress_cb(run, len(run_plans), run.count_changes(S, run_plans, indexes))
+      if not dry_run :
+        run.apply_dispatch(S, run_plans, indexes)
+    if not dry_run :
+      S.commit()
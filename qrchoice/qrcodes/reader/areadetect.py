@@ -22,6 +22,7 @@ import pillowOkularViewer
 
 from . import zbarReader
 from ...im_enhancer import imfilters, ImFilter, FilterQueue
+from ...images import openDraft
 
 from .ui_qrcdetectwidget import Ui_QRCDetectWidget
 
@@ -90,9 +91,13 @@ class QRCDetectWidget(AddFilterHandler, QWidget):
     self.ui.setupUi(self)
     
 
+  # Size (px) the qr code area should have at least, the image is decoded at the smallest JPEG draft scale that keeps it
+  detect_size = 600
+
   def __init__(self):
     self._qtinit()
-    self._im = None
+    self._path = None
+    self._ims = {} # type: dict[float, tuple[Image.Image, float, float]] # decoded image by draft scale
     self._box = None
     self.pixmap = QPixmap()
     self._filtered = None
@@ -120,9 +125,18 @@ class QRCDetectWidget(AddFilterHandler, QWidget):
 
 
   def setIm(self, path:str):
-    self._im = Image.open(path)
+    self._path = path
+    self._ims = {}
     self._update()
 
+  def _imForBox(self):
+    extent = np.max(np.max(self._box, axis=0) - np.min(self._box, axis=0))
+    needed = min(1., self.detect_size / max(extent, 1))
+    scale = next( s for s in (1/8, 1/4, 1/2, 1) if s >= needed )
+    if scale not in self._ims :
+      self._ims[scale] = openDraft(self._path, scale)
+    return self._ims[scale]
+
   def setBox(self, box:list[list[int]]):
     if box :
       self._box = np.array(box)
@@ -131,14 +145,15 @@ class QRCDetectWidget(AddFilterHandler, QWidget):
     self._update()
 
   def _update(self):
-    if self._im is None or self._box is None :
+    if self._path is None or self._box is None :
       self._base_extracted = None
       self.pixmap.swap(QPixmap())
       self.ui.imViewer.setPixmap(self.pixmap)
       self.ui.info.setText('')
       return
     self.ui.info.setText('')
-    self._base_extracted = extractArea(self._im, self._box)
+    im, fx, fy = self._imForBox()
+    self._base_extracted = extractArea(im, self._box * np.array([fx, fy]))
     self.filter()
 
   @Slot()
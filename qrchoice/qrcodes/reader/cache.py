@@ -0,0 +1,118 @@
+import time
+from collections import deque
+
+import sqlalchemy as sa
+
+from ...database import _QRCDecodeCache as D, chunked
+from ...images import fileFingerprint, imGenerator
+from . import BaseReader, QRCDetection, readPaths
+
+
+class DecodeCache(object):
+  """
+  Persistent cache of the detections, stored in the _qrc_decode_cache table of the database.
+  Entries are keyed by a hash of the reader configuration and a fingerprint of the image file (see images.fileFingerprint),
+  so a same photo read in another run (or under another name) is not decoded again. Only the max_entries most recently used entries are kept.
+  """
+  def __init__(self, reader:BaseReader, max_entries=100000):
+    self.reader = reader
+    self.max_entries = max_entries
+    self._salt = reader.configKey().encode('utf8')
+
+  def key(self, path) -> str:
+    return fileFingerprint(path, self._salt)
+
+  def get(self, S:sa.orm.Session, keys) -> dict[str, QRCDetection]:
+    """
+    Return the cached detections of keys (missing keys are not in the result). Nothing is written, see touch
+    """
+    res = {}
+    for chunk in chunked(set(keys)) :
+      res.update(S.execute(sa.select(D.key, D.data).where(D.key.in_(chunk))).all())
+    return { k: [ (data, box) for data, box in v ] for k, v in res.items() }
+
+  def touch(self, S:sa.orm.Session, keys):
+    """
+    Mark the entries of keys as used (for the eviction)
+    """
+    t = time.time()
+    for chunk in chunked(set(keys)) :
+      S.execute(sa.update(D.__table__).where(D.key.in_(chunk)).values(last_used=t))
+
+  def put(self, S:sa.orm.Session, key, detection:QRCDetection):
+    S.execute(
+      sa.insert(D.__table__).prefix_with('OR REPLACE'),
+      {'key': key, 'data': [ [data, box] for data, box in detection ], 'last_used': time.time()}
+    )
+
+  def evict(self, S:sa.orm.Session):
+    """
+    Delete the least recently used entries above max_entries
+    """
+    keep = sa.select(D.key).order_by(D.last_used.desc()).limit(self.max_entries)
+    S.execute(sa.delete(D.__table__).where(D.key.not_in(keep.scalar_subquery())))
+
+  def lookup(self, S:sa.orm.Session, paths) -> tuple[list[str], dict[str, QRCDetection]]:
+    """
+    Return the keys of paths, and the cached detections among them
+    """
+    keys = [ self.key(p) for p in paths ]
+    return keys, self.get(S, keys)
+
+  def lookups(self, db, paths, chunk_size=32):
+    """
+    Lazily yield (path, key, cached detection or None) for each path. The paths are looked up by chunks, each one in
+    its own short read-only session, so this can run in a thread while another session writes the results.
+    """
+    for chunk in chunked(paths, chunk_size) :
+      with db.session() as S :
+        keys, cached = self.lookup(S, chunk)
+      for p, k in zip(chunk, keys) :
+        yield p, k, cached.get(k)
+
+  def decode(self, items, jobs=1, loader=imGenerator):
+    """
+    items are (path, key, cached detection or None), as yielded by lookups.
+    Lazily yield (path, key, detection, is_new) for each item, in the same order. Only the images without a cached detection
+    are decoded, and an image appearing several times (same key) is decoded once (is_new is only True for the first one).
+    """
+    waiting = deque() # type: deque[tuple[object, str, QRCDetection, bool]] # items read, and whether they are the first of their key
+    submitted = deque() # type: deque[str] # keys of the images sent to readPaths, in order
+    decoded = {} # type: dict[str, QRCDetection]
+    def toDecode():
+      for p, k, detection in items :
+        first = detection is None and k not in decoded and k not in submitted
+        waiting.append((p, k, detection, first))
+        if first :
+          submitted.append(k)
+          yield p
+    results = readPaths(self.reader, toDecode(), jobs, loader=loader)
+    done = False
+    while True :
+      while waiting and (waiting[0][2] is not None or waiting[0][1] in decoded) :
+        p, k, detection, first = waiting.popleft()
+        if detection is None :
+          yield p, k, decoded[k], first
+        else :
+          yield p, k, detection, False
+      if done :
+        break
+      try :
+        decoded[submitted[0]] = next(results)
+        submitted.popleft()
+      except StopIteration :
+        done = True
+    assert not waiting
+
+  def readPaths(self, S:sa.orm.Session, paths, jobs=1, loader=imGenerator):
+    """
+    Same as reader.readPaths, but only the images that are not in the cache are decoded (and then added to it)
+    """
+    paths = list(paths)
+    keys, cached = self.lookup(S, paths)
+    for _, k, detection, is_new in self.decode(zip(paths, keys, map(cached.get, keys)), jobs, loader) :
+      if is_new :
+        self.put(S, k, detection)
+      elif k in cached :
+        self.touch(S, [k])
+      yield detection
@@ -0,0 +1,209 @@
+from dataclasses import dataclass
+from collections import deque
+from typing import Iterable
+from pathlib import Path
+from queue import Queue, Full
+import threading
+import time
+
+from ...images import imGenerator
+from . import BaseReader, QRChoiceRun, readPaths
+from .cache import DecodeCache
+
+
+@dataclass
+class StageCounter(object):
+  """
+  Throughput counter of a pipeline stage : count items were produced in busy seconds, and the stage waited wait seconds on its queue.
+  """
+  name: str
+  count: int = 0
+  busy: float = 0.
+  wait: float = 0.
+
+  @property
+  def rate(self) -> float:
+    return self.count / self.busy if self.busy else 0.
+
+  def __str__(self):
+    return f'{self.name} : {self.count} images, {self.rate:.2f} im/s, {self.busy:.2f}s busy, {self.wait:.2f}s waiting'
+
+def counted(it, counter:StageCounter):
+  """
+  Yield from it, counting the items and the time spent to get them in counter
+  """
+  it = iter(it)
+  while True :
+    start = time.perf_counter()
+    try :
+      v = next(it)
+    except StopIteration :
+      return
+    finally :
+      counter.busy += time.perf_counter() - start
+    counter.count += 1
+    yield v
+
+
+_END = object()
+_ABORT = object()
+
+class _Aborted(Exception):
+  pass
+
+class ReadPipeline(object):
+  """
+  Read the images of a run in stages connected by bounded queues :
+  loader (images.imGenerator, possibly prefetching) -> decoder (reader, possibly in a process pool) -> writer thread.
+  The writer thread owns the database session and commits by batches (see QRChoiceRun.update_imgs_batched),
+  so decoding goes on while the detections are written. When the writer lags, the decoder blocks on the full queue (back-pressure).
+  If a DecodeCache is given, a lookup thread fingerprints the files and queries the cache ahead of the decoder (see DecodeCache.lookups),
+  only the images missing from the cache reach the loader, and the writer stores the new detections.
+  """
+  def __init__(self, qrc_run:QRChoiceRun, reader:BaseReader, jobs=1, loader=imGenerator, queue_size=64, cache:DecodeCache=None, batch_size=500, interval=60.):
+    self.qrc_run = qrc_run
+    self.reader = reader
+    self.jobs = jobs
+    self.loader = loader
+    self.queue_size = queue_size
+    self.cache = cache
+    self.batch_size = batch_size
+    self.interval = interval
+    self.counters = {
+      name: StageCounter(name)
+      for name in (('lookup',) if cache is not None else ()) + ('loader', 'decoder', 'writer')
+    }
+
+  def decoded(self, paths:Iterable[Path]):
+    """
+    Yield (path, cache key, detection, is_new) for each path, the key is None without cache
+    """
+    loader = lambda paths: counted(self.loader(paths), self.counters['loader'])
+    if self.cache is None :
+      sent = deque()
+      def send():
+        for p in paths :
+          sent.append(p)
+          yield p
+      for detection in readPaths(self.reader, send(), self.jobs, loader=loader) :
+        yield sent.popleft(), None, detection, True
+      return
+    q = Queue(self.queue_size)
+    errors = []
+    stop = threading.Event()
+    lookup = threading.Thread(target=self._lookup, args=(paths, q, errors, stop), daemon=True)
+    lookup.start()
+    decoder = self.counters['decoder']
+    def items():
+      while True :
+        start = time.perf_counter()
+        item = q.get()
+        # waiting for the lookups is not decoding (this time is counted in decoder.busy by run)
+        t = time.perf_counter() - start
+        decoder.busy -= t
+        decoder.wait += t
+        if item is _END :
+          break
+        yield item
+      if errors :
+        raise errors[0]
+    try :
+      yield from self.cache.decode(items(), self.jobs, loader)
+    finally :
+      stop.set()
+      lookup.join()
+
+  def _lookup(self, paths:Iterable[Path], q:Queue, errors:list, stop:threading.Event):
+    counter = self.counters['lookup']
+    running = lambda: not stop.is_set()
+    try :
+      for item in counted(self.cache.lookups(self.qrc_run.db, paths), counter) :
+        self._put(q, item, running, counter)
+        if stop.is_set() :
+          return
+    except BaseException as e :
+      errors.append(e)
+    finally :
+      self._put(q, _END, running, counter)
+
+  def run(self, paths:Iterable[Path], progress_cb=lambda n:None):
+    """
+    Read and write the images of paths, which are consumed lazily (they can be a long running scan).
+    progress_cb is called with the number of images received by the writer
+    """
+    q = Queue(self.queue_size)
+    errors = []
+    writer = threading.Thread(target=self._write, args=(q, errors, progress_cb), daemon=True)
+    writer.start()
+    decoder = self.counters['decoder']
+    loader_busy = self.counters['loader'].busy
+    end = _ABORT
+    try :
+      for item in counted(self.decoded(paths), decoder) :
+        self._put(q, item, writer.is_alive, decoder)
+        if not writer.is_alive() :
+          break
+      else :
+        end = _END
+    finally :
+      if writer.is_alive() :
+        self._put(q, end, writer.is_alive, decoder)
+      writer.join()
+    if errors :
+      raise errors[0]
+    # the decoder time includes the loading time if the images are loaded in this process
+    if self.jobs <= 1 :
+      decoder.busy -= self.counters['loader'].busy - loader_busy
+
+  def _put(self, q:Queue, item, alive, counter:StageCounter):
+    """
+    Put item in q, unless the consumer stops (alive() is False) while q is full
+    """
+    start = time.perf_counter()
+    try :
+      while alive() :
+        try :
+          q.put(item, timeout=0.1)
+          return
+        except Full :
+          pass
+    finally :
+      counter.wait += time.perf_counter() - start
+
+  def _write(self, q:Queue, errors:list, progress_cb):
+    counter = self.counters['writer']
+    count = counter.count
+    start = time.perf_counter() - counter.busy - counter.wait
+    try :
+      with self.qrc_run.db.session() as S :
+        def results():
+          while True :
+            t = time.perf_counter()
+            item = q.get()
+            counter.wait += time.perf_counter() - t
+            if item is _END :
+              return
+            if item is _ABORT :
+              # the decoder raised : keep the checkpoint (the decoder exception is raised by run)
+              raise _Aborted()
+            p, k, detection, is_new = item
+            if k is not None :
+              if is_new :
+                self.cache.put(S, k, detection)
+              else :
+                self.cache.touch(S, [k])
+            yield p, detection
+        def progress(n):
+          counter.count = count + n
+          progress_cb(n)
+        self.qrc_run.update_imgs_batched(S, results(), self.batch_size, self.interval, progress_cb=progress)
+        if self.cache is not None :
+          self.cache.evict(S)
+          S.commit()
+    except BaseException as e :
+      errors.append(e)
+    finally :
+      counter.busy = time.perf_counter() - start - counter.wait
+
+  def report(self) -> str:
+    return '\n'.join( str(c) for c in self.counters.values() )
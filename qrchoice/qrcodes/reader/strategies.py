@@ -0,0 +1,298 @@
+import time
+from math import ceil
+from itertools import combinations_with_replacement, islice
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from ...images import openDraft
+from ...im_enhancer import parseFilters
+from . import BaseReader, QRCDetection, zbarReader, satisfies, isComplete
+
+try :
+  import cv2
+  import numpy as np
+except ImportError :
+  cv2 = None
+
+
+def scalePolygon(polygon, fx, fy):
+  return [ [round(x * fx), round(y * fy)] for x, y in polygon ]
+
+def polygonBBox(polygon):
+  xs = [ x for x, _ in polygon ]
+  ys = [ y for _, y in polygon ]
+  return min(xs), min(ys), max(xs), max(ys)
+
+def polygonArea(polygon):
+  return abs(sum( x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(polygon, polygon[1:] + polygon[:1]) )) / 2
+
+def bboxIntersect(b1, b2):
+  return b1[0] <= b2[2] and b2[0] <= b1[2] and b1[1] <= b2[3] and b2[1] <= b1[3]
+
+def dedupCodes(codes:QRCDetection) -> QRCDetection:
+  """
+  Merge the codes with the same data whose polygons overlap, keeping the largest polygon (the other ones may be cut by a tile border)
+  """
+  kept = [] # type: list[tuple[str, list, tuple]]
+  for data, polygon in sorted(codes, key=lambda c: polygonArea(c[1]), reverse=True) :
+    bbox = polygonBBox(polygon)
+    if not any( d == data and bboxIntersect(b, bbox) for d, _, b in kept ) :
+      kept.append((data, polygon, bbox))
+  return [ (data, polygon) for data, polygon, _ in kept ]
+
+
+class MultiScaleReader(BaseReader):
+  """
+  Read the qr codes on downscaled grayscale copies of the image first (long side resized to each of max_sizes),
+  and only go to the next size, and finally the full resolution, until the codes found are enough for `expected`
+  (a number of codes, or the ExpectedCodes of the run, see isComplete).
+  If the image is a JPEG file that is not decoded yet, the downscaled copies are decoded in draft mode from the file,
+  so the full resolution is only decoded when needed.
+  Returned polygons are in the original image coordinates.
+  """
+  def __init__(self, reader:BaseReader=zbarReader, max_sizes=(1600, 3200), expected=1):
+    super().__init__()
+    self.reader = reader
+    self.max_sizes = sorted(max_sizes)
+    self.expected = expected
+
+  @staticmethod
+  def isLazyJPEG(im:Image.Image):
+    return im.format == 'JPEG' and getattr(im, 'fp', None) is not None and bool(getattr(im, 'filename', None))
+
+  def readQRCodes(self, im:Image.Image) -> QRCDetection:
+    w, h = im.size
+    gray = None
+    found = {} # type: dict[str, list[list[int]]]
+    for size in self.max_sizes :
+      f = size / max(w, h)
+      if f >= 1 :
+        break
+      if self.isLazyJPEG(im) :
+        small, _, _ = openDraft(im.filename, f, 'L')
+      else :
+        if gray is None :
+          gray = im if im.mode == 'L' else im.convert('L')
+        small = gray
+      target = (max(1, round(w * f)), max(1, round(h * f)))
+      if small.size != target :
+        small = small.resize(target, Image.BILINEAR)
+      for data, polygon in self.reader.readQRCodes(small) :
+        found.setdefault(data, scalePolygon(polygon, w / target[0], h / target[1]))
+      if isComplete(list(found.items()), self.expected) :
+        return list(found.items())
+    if gray is None :
+      gray = im if im.mode == 'L' else im.convert('L')
+    # full resolution polygons are more precise
+    for data, polygon in self.reader.readQRCodes(gray) :
+      found[data] = polygon
+    return list(found.items())
+
+
+class ThreadedReader(BaseReader):
+  """
+  Reader calling a function on several items in a pool of `threads` threads, created once (or inline if threads <= 1, see mapThreads)
+  """
+  def __init__(self, threads=1):
+    super().__init__()
+    self.threads = threads
+    self._executor = ThreadPoolExecutor(threads) if threads > 1 else None
+
+  def __getstate__(self):
+    # the thread pool can't be pickled (readers are sent to the decoding processes), each process creates its own
+    state = self.__dict__.copy()
+    del state['_executor']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+  def mapThreads(self, f, items):
+    if self._executor is None :
+      return [ f(item) for item in items ]
+    return self._executor.map(f, items)
+
+
+class TiledReader(ThreadedReader):
+  """
+  Split the image in tiles of tile_size px overlapping by `overlap` px (which should be larger than a qr code),
+  read each tile (in `threads` threads, pyzbar releases the GIL), and map the codes back to global coordinates.
+  A code seen in several tiles is only kept once.
+  If `expected` is given, the remaining tiles are skipped as soon as the codes found are enough (see isComplete).
+  """
+  def __init__(self, reader:BaseReader=zbarReader, tile_size=2000, overlap=400, threads=1, expected=None):
+    if not 0 <= overlap < tile_size :
+      raise ValueError(f'The tile overlap ({overlap}) must be positive and smaller than the tile size ({tile_size})')
+    super().__init__(threads)
+    self.reader = reader
+    self.tile_size = tile_size
+    self.overlap = overlap
+    self.expected = expected
+
+  def positions(self, length):
+    if length <= self.tile_size :
+      return [0]
+    step = self.tile_size - self.overlap
+    count = ceil((length - self.overlap) / step)
+    return [ min(i * step, length - self.tile_size) for i in range(count) ]
+
+  def tiles(self, w, h):
+    return [
+        (x, y, min(x + self.tile_size, w), min(y + self.tile_size, h))
+      for y in self.positions(h)
+      for x in self.positions(w)
+    ]
+
+  def readTile(self, im:Image.Image, box) -> QRCDetection:
+    x0, y0, _, _ = box
+    return [
+        (data, [ [x + x0, y + y0] for x, y in polygon ])
+      for data, polygon in self.reader.readQRCodes(im.crop(box))
+    ]
+
+  def readQRCodes(self, im:Image.Image) -> QRCDetection:
+    im.load() # crop from several threads on a loaded image only
+    tiles = self.tiles(*im.size)
+    wave_size = max(self.threads, 1)
+    codes = []
+    for i in range(0, len(tiles), wave_size) :
+      wave = tiles[i:i + wave_size]
+      res = self.mapThreads(lambda box: self.readTile(im, box), wave)
+      codes.extend( c for det in res for c in det )
+      if self.expected is not None and isComplete(codes, self.expected) :
+        break
+    return dedupCodes(codes)
+
+
+class FilteredReader(BaseReader):
+  """
+  Apply im_enhancer filters (space separated short names, as for `im-enhance -f`) to the image before reading it
+  """
+  def __init__(self, reader:BaseReader=zbarReader, filters='c+ s+'):
+    super().__init__()
+    self.reader = reader
+    self.filters = filters
+    self._queue = parseFilters(filters)
+
+  def readQRCodes(self, im:Image.Image) -> QRCDetection:
+    return self.reader.readQRCodes(self._queue.cb(im))
+
+
+class OpenCVReader(BaseReader):
+  """
+  Read the qr codes with the OpenCV QR code detector (only if opencv is installed, see `available`)
+  """
+  available = cv2 is not None
+
+  def readQRCodes(self, im:Image.Image) -> QRCDetection:
+    ok, datas, points, _ = cv2.QRCodeDetector().detectAndDecodeMulti(np.asarray(im.convert('L')))
+    if not ok :
+      return []
+    return [
+        (data, [ [round(float(x)), round(float(y))] for x, y in polygon ])
+      for data, polygon in zip(datas, points)
+      if data
+    ]
+
+
+class FallbackReader(BaseReader):
+  """
+  Run the stages [(name, reader), ...] in order, and only go to the next (slower, more robust) one while the codes found so far
+  don't satisfy `expected` (see satisfies). Results of the stages are merged.
+  The number of calls, the number of images a stage completed, and the time spent are kept per stage in `stats`.
+  """
+  def __init__(self, stages:list[tuple[str, BaseReader]], expected=None):
+    super().__init__()
+    self.stages = stages
+    self.expected = expected
+    self._stats = { name: [0, 0, 0.] for name, _ in stages } # type: dict[str, list] # calls, completed, seconds
+
+  @property
+  def stats(self):
+    return self._stats
+
+  def readQRCodes(self, im:Image.Image) -> QRCDetection:
+    found = {} # type: dict[str, list[list[int]]]
+    for name, reader in self.stages :
+      st = self._stats[name]
+      t0 = time.perf_counter()
+      for data, polygon in reader.readQRCodes(im) :
+        found.setdefault(data, polygon)
+      st[0] += 1
+      st[2] += time.perf_counter() - t0
+      if satisfies(list(found.items()), self.expected) :
+        st[1] += 1
+        break
+    return list(found.items())
+
+  def report(self) -> str:
+    return '\n'.join(
+        f'{name} : {calls} images, {completed} completed, {seconds:.2f}s ({seconds / max(calls, 1):.3f}s/image)'
+      for name, (calls, completed, seconds) in self._stats.items()
+    )
+
+
+class FilterSearchReader(ThreadedReader):
+  """
+  Read the image with reader, and if the codes don't satisfy `expected`, search combinations of up to max_depth im_enhancer
+  filters (at most max_tries of them, shortest first), read with search_reader in `threads` threads.
+  The search stops as soon as a combination finds new codes and the codes found satisfy `expected`.
+  The combinations that found new codes are counted in `stats`.
+  """
+  def __init__(self, reader:BaseReader=zbarReader, search_reader:BaseReader=zbarReader, filters=('c+', 'c-', 'b+', 'b-', 's+', 's-'),
+      max_depth=2, max_tries=20, threads=1, expected=None):
+    super().__init__(threads)
+    self.reader = reader
+    self.search_reader = search_reader
+    self.filters = list(filters)
+    self.max_depth = max_depth
+    self.max_tries = max_tries
+    self.expected = expected
+    self._stats = {} # type: dict[str, int]
+
+  @property
+  def stats(self):
+    return self._stats
+
+  def combinations(self) -> list[str]:
+    """
+    Filter combinations to try, shortest first, without a filter and its opposite (e.g. `c+` and `c-`) together.
+    The order of the filters is not searched (`b+ c+` is tried, not `c+ b+`), a filter can be repeated (`c+ c+`).
+    """
+    def valid(combo):
+      return not any( f[:-1] + ('-' if f[-1] == '+' else '+') in combo for f in combo )
+    combos = (
+        ' '.join(combo)
+      for depth in range(1, self.max_depth + 1)
+      for combo in combinations_with_replacement(self.filters, depth)
+      if valid(combo)
+    )
+    return list(islice(combos, self.max_tries))
+
+  def tryFilters(self, im:Image.Image, filters:str) -> QRCDetection:
+    return self.search_reader.readQRCodes(parseFilters(filters).cb(im))
+
+  def readQRCodes(self, im:Image.Image) -> QRCDetection:
+    found = dict(self.reader.readQRCodes(im))
+    if satisfies(list(found.items()), self.expected) :
+      return list(found.items())
+    im.load()
+    combos = self.combinations()
+    wave_size = max(self.threads, 1)
+    for i in range(0, len(combos), wave_size) :
+      wave = combos[i:i + wave_size]
+      for filters, det in zip(wave, self.mapThreads(lambda f: self.tryFilters(im, f), wave)) :
+        new = [ (data, polygon) for data, polygon in det if data not in found ]
+        if new :
+          found.update(new)
+          self._stats[filters] = self._stats.get(filters, 0) + 1
+          if satisfies(list(found.items()), self.expected) :
+            return list(found.items())
+    return list(found.items())
+
+  def report(self) -> str:
+    return '\n'.join(
+        f'filters "{filters}" : {count} images'
+      for filters, count in sorted(self._stats.items(), key=lambda e: -e[1])
+    )
@@ -36,7 +36,7 @@ setup(
     test_suite=None,
     include_package_data=True,
     zip_safe=False,
-    install_requires=['sqlalchemy>=1.4', 'click>=7', 'rectpack>=0.2.2'],
+    install_requires=['sqlalchemy>=1.4', 'click>=7', 'rectpack>=0.2.2', 'fonttools>=4.30'],
     extras_require=['qrcode', 'pyzbar'],
     entry_points={
       'console_scripts':[